@@ -0,0 +1,168 @@
+#!/usr/bin/python
+#
+#       Resident agent holding warm Azure Blob clients
+#       and the HiveServer2 SSH tunnel for the stages
+#
+#       Author: Kyle Dunn (kdunn[9][2][6][@]gmail)
+#               (c) Dunn Infinite Designs LLC (2015)
+#
+#       Run one agent per node (e.g. from an init script or
+#       supervisor) with agent.enabled set in the pipeline:
+#
+#               $ /data/scripts/agent.py
+#
+#       intake.py and push.py then hand their blob operations
+#       to the agent over a local socket instead of reading keys
+#       and opening new TLS connections for every file. Keys are
+#       re-read whenever their files change. Nothing breaks if
+#       the agent is down; the stages connect directly.
+#
+
+from os import remove, devnull, chmod
+from os.path import exists
+from socket import socket, AF_INET, SOCK_STREAM, error as socketError
+from subprocess import Popen
+from threading import Thread, Lock
+from time import sleep, time
+from multiprocessing.connection import Listener
+
+import pipeline
+import clients
+import metrics
+
+config = pipeline.load()
+settings = config.agent
+
+# (edge node, HiveServer2, port) -> ssh process
+tunnels = {}
+tunnelLock = Lock()
+
+logFile = config.paths['logs'] + "/agent-{0}.log".format(str(int(time())))
+
+theLog = open(logFile, 'w+')
+logLock = Lock()
+
+
+def log(message):
+    with logLock:
+        theLog.write(message + "\n")
+        theLog.flush()
+
+
+def portIsOpen(port):
+    s = socket(AF_INET, SOCK_STREAM)
+    try:
+        s.connect(("localhost", port))
+        return True
+    except socketError:
+        return False
+    finally:
+        s.close()
+
+
+def ensureTunnel(edgeNode, hiveServer2, port):
+    # One long-lived tunnel per HiveServer2, restarted
+    # whenever ssh has exited, shared by every push
+    with tunnelLock:
+        key = (edgeNode, hiveServer2, port)
+
+        ssh = tunnels.get(key)
+        if ssh is not None and ssh.poll() is None:
+            return True
+
+        log("Opening SSH tunnel to edge node {0}".format(edgeNode))
+        ssh = Popen(["ssh", "-4", edgeNode,
+                     "-L{port}:{hs2}:{port}".format(hs2=hiveServer2, port=port),
+                     "-N", "-o", "ExitOnForwardFailure=yes", "-o", "ServerAliveInterval=30"],
+                    stdout=open(devnull, 'w'), stderr=theLog)
+        tunnels[key] = ssh
+
+        # Give the forward a moment to come up
+        for i in range(30):
+            if ssh.poll() is not None:
+                log("SSH tunnel exited with {0}".format(ssh.returncode))
+                return False
+            if portIsOpen(port):
+                return True
+            sleep(1)
+
+        return False
+
+
+def handle(request):
+    if request[0] == 'blob':
+        account, keyFile, method, args, kwargs = request[1:]
+        if method not in clients.agentBlobMethods:
+            raise ValueError("method not allowed: {0}".format(method))
+
+        # Progress of the caller's transfer, recorded
+        # under its run (see AgentBlobService)
+        if isinstance(kwargs.get('progress_callback'), tuple):
+            kwargs['progress_callback'] = metrics.Progress(config.metrics, *kwargs['progress_callback'])
+
+        azureStorage = clients.localBlobService(account, keyFile, settings['poolSize'])
+        return getattr(azureStorage, method)(*args, **kwargs)
+
+    if request[0] == 'hive-tunnel':
+        return ensureTunnel(*request[1:])
+
+    raise ValueError("unknown request: {0}".format(request[0]))
+
+
+def serve(connection):
+    try:
+        while True:
+            try:
+                request = connection.recv()
+            except EOFError:
+                break
+
+            try:
+                connection.send(('ok', handle(request)))
+            except Exception as e:
+                # AzureHttpError and its subclasses carry a status
+                # code the caller uses to rebuild the same exception
+                statusCode = getattr(e, 'status_code', None)
+                if statusCode is not None:
+                    connection.send(('error', 'http', str(e), statusCode))
+                else:
+                    log("Request {0} failed: {1}".format(request[:4], e))
+                    connection.send(('error', 'other', str(e), None))
+    finally:
+        connection.close()
+
+
+authkey = None
+if settings['authkeyFile']:
+    authkey = clients.readSecret(settings['authkeyFile']).encode('utf-8')
+
+socketPath = str(settings['socket'])
+if exists(socketPath):
+    remove(socketPath)
+
+listener = Listener(socketPath, family='AF_UNIX', authkey=authkey)
+
+# Only this user's stages may borrow the credentials
+chmod(socketPath, 0o600)
+
+log("Agent listening on {0}".format(socketPath))
+
+try:
+    while True:
+        try:
+            connection = listener.accept()
+        except Exception as e:
+            # e.g. a client with the wrong authkey
+            log("Rejected connection: {0}".format(e))
+            continue
+
+        t = Thread(target=serve, args=(connection,))
+        t.daemon = True
+        t.start()
+finally:
+    listener.close()
+
+    for ssh in tunnels.values():
+        ssh.terminate()
+
+    theLog.close()
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+#
+#       Startup benchmark for the incrond entry points
+#
+#       Author: Kyle Dunn (kdunn[9][2][6][@]gmail)
+#               (c) Dunn Infinite Designs LLC (2015)
+#
+#       A delivery fires many events the stages ignore
+#       (.md5, .docx, .todo, unknown data sets). This times
+#       a fresh interpreter handling each of those against a
+#       throwaway pipeline, next to bare interpreter startup
+#       and the import cost of the modules the fast paths
+#       avoid, e.g.:
+#
+#               $ python benchStartup.py 20 > bench_output.txt
+#
+
+from sys import argv, executable
+from os import environ, devnull
+from os.path import dirname, abspath, join
+from json import load, dump
+from shutil import rmtree
+from subprocess import call
+from tempfile import mkdtemp
+from time import time
+
+scriptsDir = dirname(abspath(__file__))
+
+runs = 10
+if len(argv) > 1:
+    runs = int(argv[1])
+
+heavyModules = ['chardet.universaldetector', 'azure.storage.blob', 'subprocess',
+                'multiprocessing', 'zipfile', 'socket']
+
+
+def timeCommand(command, env=None):
+    # Median wall time of a fresh process, in milliseconds
+    samples = []
+    for i in range(runs):
+        started = time()
+        call(command, env=env)
+        samples.append((time() - started) * 1000.0)
+    samples.sort()
+    return samples[len(samples) // 2]
+
+
+scratchDir = mkdtemp()
+
+try:
+    # Point a copy of the pipeline at the scratch directory
+    # so the ignore paths can't touch real data
+    with open(join(scriptsDir, "pipeline.json")) as f:
+        definition = load(f)
+
+    for key in ['staging', 'loading', 'meta', 'logs']:
+        definition['paths'][key] = scratchDir
+
+    configFile = join(scratchDir, "pipeline.json")
+    with open(configFile, 'w') as f:
+        dump(definition, f)
+
+    env = dict(environ)
+    env['AUTOETL_PIPELINE'] = configFile
+
+    baseline = timeCommand([executable, "-c", "pass"])
+
+    print("{0} runs per case, median wall time\n".format(runs))
+    print("{0:<40} {1:>8.1f} ms".format("interpreter only", baseline))
+
+    cases = [
+        ("intake.py", "Delivery20151103.md5"),
+        ("intake.py", "Manifest.docx"),
+        ("push.py", "Allergies.todo"),
+        ("push.py", "RowCounts.txt"),
+        ("push.py", "Unknown.txt"),
+        ("push.py", ".Allergies.txt.part"),
+        ("unpack.py", ".Delivery20151103.zip.gz.part")
+    ]
+
+    for script, ignoredFile in cases:
+        path = join(scratchDir, ignoredFile)
+        open(path, 'a').close()
+
+        elapsed = timeCommand([executable, join(scriptsDir, script), path], env=env)
+        print("{0:<40} {1:>8.1f} ms  (+{2:.1f})".format(script + " " + ignoredFile,
+                                                        elapsed, elapsed - baseline))
+
+    print("\nImport cost avoided on those paths\n")
+    for module in heavyModules:
+        command = [executable, "-c", "import " + module]
+        with open(devnull, 'w') as quiet:
+            missing = call(command, stderr=quiet) != 0
+
+        if missing:
+            print("{0:<40} {1:>8}".format(module, "n/a"))
+            continue
+
+        elapsed = timeCommand(command)
+        print("{0:<40} {1:>8.1f} ms  (+{2:.1f})".format(module, elapsed, elapsed - baseline))
+finally:
+    rmtree(scratchDir)
@@ -0,0 +1,216 @@
+#
+#       Credential and client caching shared by all stages
+#
+#       Author: Kyle Dunn (kdunn[9][2][6][@]gmail)
+#               (c) Dunn Infinite Designs LLC (2015)
+#
+#       Secrets are re-read only when their file changes and
+#       BlobService clients are kept per account on a pooled,
+#       keep-alive HTTP session. Inside a long-lived process
+#       (agent.py, worker.py) that means no repeated key reads
+#       or TLS handshakes. The short-lived incrond scripts get
+#       the same benefit by borrowing the agent's warm clients
+#       over a local socket, and fall back to a direct client
+#       when no agent is running.
+#
+
+from os import stat
+
+# Secret file path -> ((mtime, size), value)
+_secrets = {}
+
+# Account -> (account key, BlobService)
+_blobServices = {}
+
+# Operations the agent will perform on a caller's behalf
+agentBlobMethods = ['delete_blob', 'put_block_blob_from_path', 'put_block',
+                    'put_block_list', 'get_blob_properties']
+
+# Calls carrying the data itself, which would otherwise be
+# pickled through the agent's socket one block at a time
+localBlobMethods = ['put_block']
+
+
+class AgentError(Exception):
+    pass
+
+
+class AgentUnavailable(AgentError):
+    # The agent went away mid-run, callers fall back
+    # to a direct client or their own tunnel
+    pass
+
+
+def readSecret(path):
+    # the super secret location, re-read
+    # only once the file has been replaced
+    fileStatInfo = stat(path)
+    version = (fileStatInfo.st_mtime, fileStatInfo.st_size)
+
+    cached = _secrets.get(path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    with open(path, 'r') as f:
+        value = f.read().strip()
+
+    _secrets[path] = (version, value)
+    return value
+
+
+def _pooledSession(poolSize):
+    # Keep-alive connections shared by every
+    # request a client makes, when available
+    try:
+        from requests import Session
+        from requests.adapters import HTTPAdapter
+    except ImportError:
+        return None
+
+    session = Session()
+    adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def localBlobService(account, keyFile, poolSize=10):
+    accountKey = readSecret(keyFile)
+
+    # A rotated key replaces the client
+    cached = _blobServices.get(account)
+    if cached is not None and cached[0] == accountKey:
+        return cached[1]
+
+    from azure.storage.blob import BlobService
+
+    session = _pooledSession(poolSize)
+    if session is not None:
+        azureStorage = BlobService(account_name=account, account_key=accountKey,
+                                   request_session=session)
+    else:
+        azureStorage = BlobService(account_name=account, account_key=accountKey)
+
+    _blobServices[account] = (accountKey, azureStorage)
+    return azureStorage
+
+
+class AgentConnection(object):
+    # One connection per process to the local agent
+
+    def __init__(self, settings):
+        from multiprocessing.connection import Client
+
+        authkey = None
+        if settings['authkeyFile']:
+            authkey = readSecret(settings['authkeyFile']).encode('utf-8')
+
+        self.connection = Client(str(settings['socket']), family='AF_UNIX', authkey=authkey)
+
+    def call(self, request):
+        global _agent
+
+        try:
+            self.connection.send(request)
+            reply = self.connection.recv()
+        except (EOFError, IOError, OSError) as e:
+            # Stop using this connection, a later agent()
+            # call reconnects if the agent comes back
+            self.connection.close()
+            if _agent is self:
+                _agent = None
+            raise AgentUnavailable("agent connection lost: {0}".format(e))
+
+        if reply[0] == 'ok':
+            return reply[1]
+
+        kind, message, statusCode = reply[1:]
+        if kind == 'http':
+            # Maps onto AzureMissingResourceHttpError etc.
+            # by status code, exactly as a local client would
+            from azure.common import AzureHttpError
+            raise AzureHttpError(message, statusCode)
+
+        raise AgentError(message)
+
+
+class AgentBlobService(object):
+    # Stands in for a BlobService, each call is
+    # executed by the agent on its cached client,
+    # or locally once the agent has gone away
+
+    def __init__(self, agent, account, keyFile, poolSize):
+        self._agent = agent
+        self._account = account
+        self._keyFile = keyFile
+        self._poolSize = poolSize
+        self._local = None
+
+    def _localService(self):
+        if self._local is None:
+            self._local = localBlobService(self._account, self._keyFile, self._poolSize)
+        return self._local
+
+    def __getattr__(self, method):
+        if method not in agentBlobMethods:
+            raise AttributeError(method)
+
+        def remoteCall(*args, **kwargs):
+            viaAgent = method not in localBlobMethods
+            remoteKwargs = kwargs
+
+            # Callbacks can't cross the socket, but the agent
+            # records a metrics.Progress from its spec itself
+            callback = kwargs.get('progress_callback')
+            if callback is not None:
+                if hasattr(callback, 'spec'):
+                    remoteKwargs = dict(kwargs, progress_callback=callback.spec())
+                else:
+                    viaAgent = False
+
+            if self._agent is not None and viaAgent:
+                try:
+                    return self._agent.call(('blob', self._account, self._keyFile, method, args, remoteKwargs))
+                except AgentUnavailable:
+                    self._agent = None
+            return getattr(self._localService(), method)(*args, **kwargs)
+        return remoteCall
+
+
+_agent = None
+
+def agent(settings):
+    # The agent connection, or None when
+    # the agent is disabled or not running
+    global _agent
+
+    if _agent is None and settings['enabled']:
+        from multiprocessing import AuthenticationError
+
+        try:
+            _agent = AgentConnection(settings)
+        except (OSError, IOError, EOFError, AuthenticationError):
+            return None
+    return _agent
+
+
+def blobService(account, keyFile, agentSettings):
+    a = agent(agentSettings)
+    if a is not None:
+        return AgentBlobService(a, account, keyFile, agentSettings['poolSize'])
+    return localBlobService(account, keyFile, agentSettings['poolSize'])
+
+
+def hiveTunnel(agentSettings, edgeNode, hiveServer2, port):
+    # True when the agent holds an SSH tunnel to
+    # HiveServer2 open, so callers need not start one
+    a = agent(agentSettings)
+    if a is None:
+        return False
+
+    try:
+        return a.call(('hive-tunnel', edgeNode, hiveServer2, port))
+    except AgentError:
+        # Including the agent going away, the
+        # caller then opens its own tunnel
+        return False
@@ -22,23 +22,40 @@
 #
 
 from sys import argv
+
+fullFilePath = argv[1]
+filename = fullFilePath.split('/')[-1]
+
+# Checked before any other imports, most
+# events in a drop are for these files
+if "MD5" in filename.upper() or "DOCX" in filename.upper():
+    # Queitly ignore the checksum and manifest files
+    exit(0)
+
 from os import stat
-from zipfile import ZipFile 
 from hashlib import md5
 from shutil import move, Error
 from os.path import isfile
 from time import sleep, time
 
-from azure.storage.blob import BlobService
 from azure.common import AzureMissingResourceHttpError, AzureHttpError
 
-stagingDir = "/data/staging"
-metaDir = "/data/meta"
-logRoot = "/data/logs"
+import pipeline
+import clients
+import compress
+import retry
+import metrics
+
+config = pipeline.load()
+
+stagingDir = config.paths['staging']
+metaDir = config.paths['meta']
+logRoot = config.paths['logs']
 
-azureAccount = 'phaprodarchive001'
-ingestContainer = 'phaprodarchivepls'
-azureKeyLocation = '/etc/hadoop/conf/keyArchive'
+azureAccount = config.intake['account']
+ingestContainer = config.intake['container']
+azureKeyLocation = config.intake['keyFile']
+maxConnections = config.intake.get('maxConnections', 5)
 
 
 def computeMd5(fname):
@@ -63,19 +80,25 @@ def validateChecksums(md5sum, md5FullFilePath):
 
     return (baselineChecksum == md5sum)
 
-fullFilePath = argv[1]
-filename = fullFilePath.split('/')[-1]
-
-if "MD5" in filename.upper() or "DOCX" in filename.upper():
-    # Queitly ignore the checksum and manifest files
-    exit(0)
-
 # Get the current time (GMT, epoch)
 startTime = int(time())
 
 # Get file metadata
 fileStatInfo = stat(fullFilePath)
 
+# With several nodes watching a shared inbound
+# directory, only the first one to decide on a
+# delivery validates, stages and archives it
+if config.distributed['enabled']:
+    import workqueue
+
+    queue = workqueue.fromConfig(config)
+    if not queue.decideOnce("intake-{0}-{1}-{2}".format(filename, fileStatInfo.st_size,
+                                                        int(fileStatInfo.st_mtime))):
+        exit(0)
+
+runId = metrics.begin(config.metrics, 'intake', filename)
+
 # Capture file metadata fields of interest
 sizeInBytes = fileStatInfo.st_size
 modificationTime = fileStatInfo.st_mtime
@@ -92,9 +115,9 @@ logFile = logRoot + "/intake-{0}.log".format(str(startTime))
 theLog = open(logFile, 'w+')
 
 isClaims = False
-if "ADA" in filename.upper():
+if config.isClaims(filename):
     isClaims = True
-    ingestContainer = 'phaprodclaimarchivepls'
+    ingestContainer = config.intake['claimsContainer']
 
 # Wait until checksum file has also landed
 while True and not isClaims:
@@ -118,25 +141,29 @@ if isClaims or validateChecksums(md5sum, md5FullFilePath):
     try:
         move(fullFilePath, stagingDir)
 
-        # the super secret location
-        accountKeyFile = open(azureKeyLocation, 'r')
-        accountKey = accountKeyFile.read().strip()
-        accountKeyFile.close()
-
-        # Get a handle on the Azure Blob Storage account
-        azureStorage = BlobService(account_name=azureAccount,
-                                   account_key=accountKey)
+        # Get a handle on the Azure Blob Storage account,
+        # borrowed from the agent when one is running
+        azureStorage = clients.blobService(azureAccount, azureKeyLocation, config.agent)
 
         checksumFilename = md5FullFilePath + ".md5"
 
+        # Log every backoff so slow transfers can be explained
+        def logRetry(operation, attempt, delay, e):
+            theLog.write("Retrying {0} (attempt {1}) in {2:.1f}s after: {3}\n".format(operation, attempt,
+                                                                                      delay, str(e)))
+            theLog.flush()
+
+        retryPolicies = retry.policies(config, onRetry=logRetry)
+
         # Ensure a clean slate for pushing the new data set
         try:
-            azureStorage.delete_blob(ingestContainer, filename)
+            retryPolicies['delete'].run(azureStorage.delete_blob, ingestContainer, filename)
             theLog.write("Existing ingest data blob found, deleting it\n\n")
             theLog.flush()
 
             if not isClaims:
-                azureStorage.delete_blob(ingestContainer, filename.split(".")[0] + ".md5")
+                retryPolicies['delete'].run(azureStorage.delete_blob, ingestContainer,
+                                            filename.split(".")[0] + ".md5")
                 theLog.write("Existing ingest checksum blob found, deleting it\n\n")
                 theLog.flush()
         except AzureMissingResourceHttpError:
@@ -151,11 +178,18 @@ if isClaims or validateChecksums(md5sum, md5FullFilePath):
         try:
             theLog.write("Writing data to Blob {3} to {0}:{1}/{2}\n".format(azureAccount, ingestContainer, filename, stagingDir+"/"+filename))
 
-            azureStorage.put_block_blob_from_path(ingestContainer,
-                                                  filename,
-                                                  stagingDir+"/"+filename,
-                                                  #content_md5=md5Checksum.encode('base64').strip(),
-                                                  max_connections=5)
+            uploadStarted = time()
+            # Block by block, so a failed block is all that's resent
+            compress.uploadFile(azureStorage,
+                                ingestContainer,
+                                filename,
+                                stagingDir+"/"+filename,
+                                #content_md5=md5Checksum.encode('base64').strip(),
+                                connections=maxConnections,
+                                retryPolicy=retryPolicies['upload'],
+                                progress=metrics.Progress(config.metrics, runId, filename))
+            metrics.timing(config.metrics, runId, 'upload', filename, time() - uploadStarted,
+                           sizeInBytes=sizeInBytes)
             theLog.write("Wrote data to Blob\n")
             sleep(5)
 
@@ -165,11 +199,12 @@ if isClaims or validateChecksums(md5sum, md5FullFilePath):
                                                                                filename.split(".")[0] + ".md5", 
                                                                                md5FullFilePath)) 
 
-                azureStorage.put_block_blob_from_path(ingestContainer,
-                                                      filename.split(".")[0] + ".md5",
-                                                      md5FullFilePath,
-                                                      #content_md5=md5Checksum.encode('base64').strip(),
-                                                      max_connections=5)
+                retryPolicies['upload'].run(azureStorage.put_block_blob_from_path,
+                                            ingestContainer,
+                                            filename.split(".")[0] + ".md5",
+                                            md5FullFilePath,
+                                            #content_md5=md5Checksum.encode('base64').strip(),
+                                            max_connections=maxConnections)
 
                 theLog.write("Wrote md5 to Blob\n") 
 
@@ -177,13 +212,13 @@ if isClaims or validateChecksums(md5sum, md5FullFilePath):
                 theLog.flush()
 
             result = "OK"
-        except OSError as e:
-            theLog.write(e)
+        except (IOError, OSError) as e:
+            theLog.write(str(e) + "\n")
             result = e
 
-        except AzureMissingResourceHttpError as e:
+        except (AzureHttpError, clients.AgentError) as e:
             theLog.write("Failed to archive one or both blobs.\n\n")
-            theLog.write(e)
+            theLog.write(str(e) + "\n")
             result = "ARCHIVE FAILED"
 
 
@@ -212,3 +247,5 @@ theFile = open(metaDir + '/stage', 'a')
 theFile.write(record)
 theFile.close()
 
+metrics.end(config.metrics, runId, result)
+
@@ -0,0 +1,201 @@
+#
+#       Run and timing index shared by all stages
+#
+#       Author: Kyle Dunn (kdunn[9][2][6][@]gmail)
+#               (c) Dunn Infinite Designs LLC (2015)
+#
+#       Every intake, unpack and push run is recorded in a small
+#       SQLite database as it starts and finishes, along with the
+#       upload and Hive statement timings within it. status.py
+#       answers its questions from indexed queries on these files
+#       instead of reading every log under /data/logs, so it stays
+#       fast with months of history.
+#
+#       Each node writes only its own database (metrics/<node>.db)
+#       in SQLite's default rollback journal mode, since WAL's
+#       shared-memory index doesn't work across the hosts sharing
+#       /data. status.py reads and merges all of them. Recording
+#       is best effort: a locked or unwritable database is skipped
+#       over and never fails a load.
+#
+
+from os import getpid, listdir, makedirs
+from os.path import join, isdir
+from socket import gethostname
+from threading import Lock
+from time import time
+
+import sqlite3
+
+schema = [
+    """CREATE TABLE IF NOT EXISTS runs (
+           id INTEGER PRIMARY KEY,
+           stage TEXT NOT NULL,
+           item TEXT NOT NULL,
+           dataset TEXT,
+           host TEXT NOT NULL,
+           pid INTEGER NOT NULL,
+           started REAL NOT NULL,
+           finished REAL,
+           result TEXT)""",
+    "CREATE INDEX IF NOT EXISTS runsStarted ON runs (started)",
+    "CREATE INDEX IF NOT EXISTS runsOpen ON runs (stage) WHERE finished IS NULL",
+    "CREATE INDEX IF NOT EXISTS runsFinished ON runs (stage, finished)",
+    "CREATE INDEX IF NOT EXISTS runsDataSet ON runs (dataset, finished)",
+    """CREATE TABLE IF NOT EXISTS timings (
+           run INTEGER,
+           kind TEXT NOT NULL,
+           name TEXT NOT NULL,
+           dataset TEXT,
+           finished REAL NOT NULL,
+           seconds REAL NOT NULL,
+           bytes INTEGER,
+           ok INTEGER NOT NULL)""",
+    "CREATE INDEX IF NOT EXISTS timingsFinished ON timings (kind, finished)",
+    # Transfers still under way, one row each
+    """CREATE TABLE IF NOT EXISTS progress (
+           run INTEGER,
+           name TEXT NOT NULL,
+           dataset TEXT,
+           started REAL NOT NULL,
+           updated REAL NOT NULL,
+           bytes INTEGER NOT NULL,
+           total INTEGER,
+           rate REAL NOT NULL,
+           PRIMARY KEY (run, name))"""
+]
+
+# Seconds between progress writes for one transfer
+progressInterval = 10
+
+_connection = None
+_connectionLock = Lock()
+
+
+def databaseFile(settings, nodeName):
+    return join(settings['directory'], nodeName.replace('/', '_') + ".db")
+
+
+def databaseFiles(settings):
+    # Every node's database, for status.py
+    if not isdir(settings['directory']):
+        return []
+    return [join(settings['directory'], name) for name in sorted(listdir(settings['directory']))
+            if name.endswith(".db")]
+
+
+def openDatabase(path, timeout=5):
+    # Shared by the agent's threads, see _write
+    c = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+    c.execute("PRAGMA journal_mode=DELETE")
+    for statement in schema:
+        c.execute(statement)
+    c.commit()
+    return c
+
+
+def connect(settings):
+    # This node's database, one connection per process (shared
+    # by its threads), or None when metrics are disabled or unusable
+    global _connection
+
+    if _connection is None and settings['enabled']:
+        with _connectionLock:
+            try:
+                if _connection is None:
+                    if not isdir(settings['directory']):
+                        makedirs(settings['directory'])
+                    _connection = openDatabase(databaseFile(settings, settings['nodeName'] or gethostname()))
+            except (sqlite3.Error, OSError):
+                return None
+    return _connection
+
+
+def _write(settings, statement, args):
+    c = connect(settings)
+    if c is None:
+        return None
+
+    try:
+        with _connectionLock:
+            cursor = c.execute(statement, args)
+            c.commit()
+            return cursor.lastrowid
+    except sqlite3.Error:
+        return None
+
+
+def begin(settings, stage, item, dataset=None):
+    # Returns the run's id (None if it couldn't be recorded)
+    return _write(settings,
+                  "INSERT INTO runs (stage, item, dataset, host, pid, started) VALUES (?, ?, ?, ?, ?, ?)",
+                  (stage, item, dataset, gethostname(), getpid(), time()))
+
+
+def end(settings, runId, result):
+    if runId is None:
+        return
+    _write(settings, "UPDATE runs SET finished = ?, result = ? WHERE id = ?",
+           (time(), str(result), runId))
+
+
+def timing(settings, runId, kind, name, seconds, dataset=None, sizeInBytes=None, ok=True):
+    # e.g. kind 'upload' with the bytes sent, or
+    # kind 'hive' named for the statement
+    _write(settings,
+           "INSERT INTO timings (run, kind, name, dataset, finished, seconds, bytes, ok) "
+           "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+           (runId, kind, name, dataset, time(), seconds, sizeInBytes, int(ok)))
+
+    # The transfer (if tracked) is no longer under way
+    if kind == 'upload':
+        _write(settings, "DELETE FROM progress WHERE run = ? AND name = ?", (runId, name))
+
+
+class Progress(object):
+    # Called with the bytes sent so far (and optionally the
+    # total) as a transfer runs, e.g. as a progress_callback,
+    # and records the current rate every progressInterval
+
+    def __init__(self, settings, runId, name, dataset=None):
+        self.settings = settings
+        self.runId = runId
+        self.name = name
+        self.dataset = dataset
+        self.started = time()
+        self.lastWrite = self.started
+        self.lastBytes = 0
+
+    def __call__(self, current, total=None):
+        now = time()
+        if now - self.lastWrite < progressInterval:
+            return
+
+        # A retried transfer starts over from zero
+        rate = max(current - self.lastBytes, 0) / (now - self.lastWrite)
+        _write(self.settings,
+               "INSERT OR REPLACE INTO progress (run, name, dataset, started, updated, bytes, total, rate) "
+               "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+               (self.runId, self.name, self.dataset, self.started, now, current, total, rate))
+
+        self.lastWrite = now
+        self.lastBytes = current
+
+    def spec(self):
+        # What the agent needs to record this
+        # transfer's progress itself, see agent.py
+        return (self.runId, self.name, self.dataset)
+
+
+def prune(settings):
+    # Drop this node's history past the retention window
+    c = connect(settings)
+    if c is None:
+        return 0
+
+    cutoff = time() - settings['retentionDays'] * 86400
+    removed = c.execute("DELETE FROM timings WHERE finished < ?", (cutoff,)).rowcount
+    removed = removed + c.execute("DELETE FROM runs WHERE started < ?", (cutoff,)).rowcount
+    removed = removed + c.execute("DELETE FROM progress WHERE updated < ?", (cutoff,)).rowcount
+    c.commit()
+    return removed
@@ -0,0 +1,136 @@
+#
+#       Encoding normalization for extracted data sets
+#
+#       Author: Kyle Dunn (kdunn[9][2][6][@]gmail)
+#               (c) Dunn Infinite Designs LLC (2015)
+#
+#       Hive reads text tables as UTF-8, so anything else is
+#       transcoded before upload. The encoding is detected from
+#       a sample rather than the whole file, then a single
+#       chunked pass decodes, re-encodes, hashes and counts
+#       lines. Files detected as UTF-8 (or ASCII) are still
+#       validated during that pass; if a sample misled the
+#       detector the file is transcoded from the fallback
+#       encoding instead.
+#
+
+from os import rename, remove, getpid
+from os.path import dirname, basename, join
+from hashlib import md5
+from codecs import getincrementaldecoder, lookup
+
+defaultChunkBytes = 1048576
+
+# Encodings which are already valid UTF-8 byte for byte
+utf8Compatible = ['utf-8', 'ascii']
+
+
+def detectEncoding(fullFilePath, sampleBytes=65536):
+    # Sample the head and the middle of the file,
+    # delivery headers are usually plain ASCII
+    from chardet.universaldetector import UniversalDetector
+
+    encodingDetector = UniversalDetector()
+    with open(fullFilePath, "rb") as f:
+        encodingDetector.feed(f.read(sampleBytes))
+
+        f.seek(0, 2)
+        middle = f.tell() // 2
+        if middle > sampleBytes:
+            f.seek(middle)
+            encodingDetector.feed(f.read(sampleBytes))
+
+    encodingDetector.close()
+    return encodingDetector.result['encoding'], encodingDetector.result['confidence']
+
+
+def _canonical(encoding):
+    try:
+        return lookup(encoding).name
+    except LookupError:
+        return None
+
+
+def _scan(fullFilePath, sourceEncoding, out, errors, chunkBytes):
+    # One pass: decode, optionally re-encode to out,
+    # and hash and count what will be uploaded
+    hash = md5()
+    lines = 0
+
+    decoder = None
+    if sourceEncoding is not None:
+        decoder = getincrementaldecoder(sourceEncoding)(errors)
+
+    with open(fullFilePath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunkBytes), b""):
+            if decoder is not None:
+                text = decoder.decode(chunk)
+
+            if out is not None:
+                chunk = text.encode('utf-8')
+                out.write(chunk)
+
+            # Tabulate the newlines in this chunk
+            lines = lines + chunk.count(b'\x0a')
+            hash.update(chunk)
+
+        if decoder is None:
+            return hash.digest(), lines
+
+        text = decoder.decode(b"", True)
+        if out is not None and text:
+            chunk = text.encode('utf-8')
+            out.write(chunk)
+            hash.update(chunk)
+            lines = lines + chunk.count(b'\x0a')
+
+    return hash.digest(), lines
+
+
+def _transcode(fullFilePath, sourceEncoding, errors, chunkBytes):
+    # Write next to the original as a hidden file (ignored
+    # by push.py) and swap it in with a rename so no other
+    # stage ever sees a partially converted data set
+    tmpPath = join(dirname(fullFilePath), ".{0}.utf8-{1}".format(basename(fullFilePath), getpid()))
+
+    try:
+        with open(tmpPath, "wb") as out:
+            digest, lines = _scan(fullFilePath, sourceEncoding, out, errors, chunkBytes)
+        rename(tmpPath, fullFilePath)
+    except:
+        try:
+            remove(tmpPath)
+        except OSError:
+            pass
+        raise
+
+    return digest, lines
+
+
+def normalizeFile(fullFilePath, sampleBytes=65536, fallbackEncoding='windows-1252',
+                  errors='replace', transcode=True, chunkBytes=defaultChunkBytes):
+    # Returns the MD5 digest and line count of the file as
+    # it will be loaded, and a note for the metadata record,
+    # e.g. "utf-8-0.99" or "windows-1252-0.73>utf-8"
+    detected, confidence = detectEncoding(fullFilePath, sampleBytes)
+    encoding = _canonical(detected) if detected else 'utf-8'
+    if encoding is None:
+        encoding = fallbackEncoding
+
+    note = "{0}-{1}".format(detected, str(confidence))
+
+    if not transcode:
+        digest, lines = _scan(fullFilePath, None, None, errors, chunkBytes)
+        return digest, note, lines
+
+    if encoding in utf8Compatible:
+        try:
+            # Strict decoding doubles as validation
+            digest, lines = _scan(fullFilePath, 'utf-8', None, 'strict', chunkBytes)
+            return digest, note, lines
+        except UnicodeDecodeError:
+            encoding = fallbackEncoding
+            note = "{0}-invalid-as-{1}".format(note, fallbackEncoding)
+
+    digest, lines = _transcode(fullFilePath, encoding, errors, chunkBytes)
+    return digest, "{0}>utf-8".format(note), lines
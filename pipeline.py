@@ -0,0 +1,356 @@
+#
+#       Declarative pipeline definition shared by
+#       the intake, unpack and push stages
+#
+#       Author: Kyle Dunn (kdunn[9][2][6][@]gmail)
+#               (c) Dunn Infinite Designs LLC (2015)
+#
+#       The definition is a JSON document (see pipeline.json)
+#       which is read once per process and validated before
+#       any stage acts on it. The AUTOETL_PIPELINE environment
+#       variable selects an alternate definition, allowing
+#       several pipelines to share one host, e.g.:
+#
+#               $ incrontab -l
+#               /data/inbound IN_CLOSE_WRITE env AUTOETL_PIPELINE=/data/scripts/pipeline.json /data/scripts/intake.py $@/$#
+#
+
+from os import environ
+from os.path import dirname, abspath, join
+from json import load as loadJson
+from codecs import lookup, lookup_error
+
+defaultConfigFile = join(dirname(abspath(__file__)), "pipeline.json")
+
+requiredPaths = ['staging', 'loading', 'meta', 'logs', 'ddlFile']
+requiredSections = {
+    'intake': ['account', 'container', 'claimsContainer', 'claimsMarker', 'keyFile'],
+    'unpack': ['unzipUtil', 'passwordFile', 'rowCountsFile'],
+    'push': ['account', 'ingestContainer', 'productionContainer', 'keyFile',
+             'targetIngestPath', 'hadoopEdgeNode', 'hiveServer2', 'hivePort',
+             'hiveDatabase', 'hiveUser', 'hivePassword', 'tablePrefix', 'stagePath',
+             'beeline']
+}
+
+insertModes = {
+    'append': "INSERT INTO TABLE",
+    # Full-extract data sources, truncate before load
+    'overwrite': "INSERT OVERWRITE TABLE"
+}
+
+storageFormats = ['TEXTFILE', 'SEQUENCEFILE', 'RCFILE', 'ORC', 'PARQUET', 'AVRO']
+
+# Codecs Hive's text input format reads by extension
+compressionCodecs = [None, 'gzip', 'bzip2']
+
+# Single-node operation unless the
+# definition turns distribution on
+distributedDefaults = {
+    'enabled': False,
+    'queueDir': "/data/queue",
+    'nodeName': None,
+    'leaseSeconds': 600,
+    'maxAttempts': 3,
+    'slots': 2,
+    'pollSeconds': 5,
+    'doneRetentionSeconds': 604800
+}
+
+# Stages connect to Azure directly
+# unless a resident agent is enabled
+agentDefaults = {
+    'enabled': False,
+    'socket': "/var/run/autoetl/agent.sock",
+    'authkeyFile': None,
+    'poolSize': 10
+}
+
+# Staging and loading disk management, see space.py
+spaceDefaults = {
+    'headroomBytes': 1073741824,
+    'reservationTtlSeconds': 86400,
+    'retention': {
+        'staging': {'action': 'delete', 'keepHours': 72},
+        'loading': {'action': 'delete', 'keepHours': 0}
+    }
+}
+
+retentionActions = ['delete', 'compact']
+
+# Per-operation retry policies, see retry.py
+retryDefaults = {
+    'upload': {'attempts': 6, 'baseDelay': 2.0, 'maxDelay': 60.0, 'budgetSeconds': 900},
+    'delete': {'attempts': 4, 'baseDelay': 1.0, 'maxDelay': 15.0, 'budgetSeconds': 60},
+    'hive': {'attempts': 4, 'baseDelay': 15.0, 'maxDelay': 300.0, 'budgetSeconds': 1800}
+}
+
+# Run and timing index read by status.py, see metrics.py
+metricsDefaults = {
+    'enabled': True,
+    'directory': None,
+    'staleSeconds': 86400,
+    'retentionDays': 400
+}
+
+
+class PipelineConfigError(ValueError):
+    pass
+
+
+class DataSet(object):
+    # A single table's settings, with the
+    # datasetDefaults already merged in
+
+    def __init__(self, name, settings):
+        self.name = name
+        self.enabled = settings['enabled']
+        self.concurrency = settings['concurrency']
+        self.ddlTable = settings['ddlTable'] or name
+        self.buckets = settings['buckets']
+        self.clusterKey = settings['clusterKey']
+        self.sortKey = settings['sortKey']
+        self.insertMode = settings['insertMode']
+        self.format = settings['format'].upper()
+        self.compositeKeys = settings['compositeKeys']
+        self.checkRowCounts = settings['checkRowCounts']
+
+    def insertStatement(self):
+        return insertModes[self.insertMode]
+
+    def layoutClause(self):
+        # e.g. CLUSTERED BY(GenClientID) SORTED BY(GenPatientID) INTO 32 BUCKETS
+        if self.clusterKey is None:
+            return ""
+
+        sortedByString = ""
+        if self.sortKey is not None:
+            sortedByString = "SORTED BY({0})".format(self.sortKey)
+
+        return "CLUSTERED BY({0}) {1} INTO {2} BUCKETS".format(self.clusterKey,
+                                                               sortedByString,
+                                                               self.buckets)
+
+
+class Pipeline(object):
+
+    def __init__(self, definition, source):
+        self.source = source
+        self.name = definition.get('name', 'default')
+        self.paths = definition['paths']
+        self.intake = definition['intake']
+        self.unpack = definition['unpack']
+        self.push = definition['push']
+        self.concurrencyClasses = definition['concurrencyClasses']
+
+        self.distributed = dict(distributedDefaults)
+        self.distributed.update(definition.get('distributed', {}))
+
+        self.agent = dict(agentDefaults)
+        self.agent.update(definition.get('agent', {}))
+
+        self.space = dict(spaceDefaults)
+        self.space.update(definition.get('space', {}))
+        self.space['retention'] = dict(spaceDefaults['retention'])
+        self.space['retention'].update(definition.get('space', {}).get('retention', {}))
+
+        self.metrics = dict(metricsDefaults)
+        self.metrics.update(definition.get('metrics', {}))
+        if self.metrics['directory'] is None:
+            self.metrics['directory'] = join(self.paths['meta'], "metrics")
+
+        # One database per node, see metrics.py (None is this
+        # host's name, looked up there rather than on every load)
+        self.metrics['nodeName'] = self.distributed['nodeName']
+
+        self.retry = {}
+        for operation, policy in retryDefaults.items():
+            self.retry[operation] = dict(policy)
+            self.retry[operation].update(definition.get('retry', {}).get(operation, {}))
+
+        defaults = definition['datasetDefaults']
+
+        # Preserve the declared order, push.py uses it
+        # to queue loads behind one another
+        self.dataSets = []
+        for entry in definition['datasets']:
+            settings = dict(defaults)
+            settings.update(entry)
+            self.dataSets.append(DataSet(entry['name'], settings))
+
+        self._byName = dict((d.name, d) for d in self.dataSets)
+
+    def enabledDataSets(self):
+        return [d for d in self.dataSets if d.enabled]
+
+    def dataSet(self, name):
+        d = self._byName.get(name)
+        if d is None or not d.enabled:
+            return None
+        return d
+
+    def lanePredecessors(self, name, depth=2):
+        # The enabled data sets which precede this one in the
+        # same concurrency lane, nearest first. A lane of null
+        # means the data set never waits on another load.
+        lane = self.concurrencyClasses[self._byName[name].concurrency]['lane']
+        if lane is None:
+            return []
+
+        sameLane = [d.name for d in self.enabledDataSets()
+                    if self.concurrencyClasses[d.concurrency]['lane'] == lane]
+
+        position = sameLane.index(name)
+        return list(reversed(sameLane[max(0, position - depth):position]))
+
+    def maxWaitSeconds(self, name):
+        return self.concurrencyClasses[self._byName[name].concurrency]['maxWaitSeconds']
+
+    def isClaims(self, filename):
+        return self.intake['claimsMarker'].upper() in filename.upper()
+
+
+def validate(definition, source):
+    def fail(message):
+        raise PipelineConfigError("{0}: {1}".format(source, message))
+
+    if not isinstance(definition, dict):
+        fail("top level must be an object")
+
+    for key in ['paths', 'concurrencyClasses', 'datasetDefaults', 'datasets'] + list(requiredSections):
+        if key not in definition:
+            fail("missing section '{0}'".format(key))
+
+    for key in requiredPaths:
+        if key not in definition['paths']:
+            fail("missing paths.{0}".format(key))
+
+    for section, keys in requiredSections.items():
+        for key in keys:
+            if key not in definition[section]:
+                fail("missing {0}.{1}".format(section, key))
+
+    for key in definition.get('distributed', {}):
+        if key not in distributedDefaults:
+            fail("unknown setting distributed.{0}".format(key))
+
+    for key in definition.get('agent', {}):
+        if key not in agentDefaults:
+            fail("unknown setting agent.{0}".format(key))
+
+    for key in definition.get('metrics', {}):
+        if key not in metricsDefaults:
+            fail("unknown setting metrics.{0}".format(key))
+
+    compression = definition['push'].get('compression', {})
+    if compression.get('codec') not in compressionCodecs:
+        fail("push.compression.codec must be one of {0}".format(compressionCodecs))
+
+    level = compression.get('level', 6)
+    if isinstance(level, bool) or not isinstance(level, int) or not 1 <= level <= 9:
+        fail("push.compression.level must be an integer from 1 to 9")
+
+    workers = compression.get('workers', 4)
+    if isinstance(workers, bool) or not isinstance(workers, int) or workers < 1:
+        fail("push.compression.workers must be a positive integer")
+
+    normalizeSettings = definition['push'].get('normalize', {})
+    try:
+        lookup(normalizeSettings.get('fallbackEncoding', 'windows-1252'))
+    except LookupError:
+        fail("push.normalize.fallbackEncoding is not a known encoding")
+
+    try:
+        lookup_error(normalizeSettings.get('errors', 'replace'))
+    except LookupError:
+        fail("push.normalize.errors is not a known error handler (e.g. strict, replace, ignore)")
+
+    spaceSettings = definition.get('space', {})
+    for key in spaceSettings:
+        if key not in spaceDefaults:
+            fail("unknown setting space.{0}".format(key))
+
+    for stage, policy in spaceSettings.get('retention', {}).items():
+        if stage not in spaceDefaults['retention']:
+            fail("space.retention.{0} is not a stage with retention".format(stage))
+        if policy.get('action') not in retentionActions or 'keepHours' not in policy:
+            fail("space.retention.{0} needs an action from {1} and keepHours".format(stage, retentionActions))
+
+    for operation, policy in definition.get('retry', {}).items():
+        if operation not in retryDefaults:
+            fail("retry.{0} is not a retried operation".format(operation))
+        for key, value in policy.items():
+            if key not in retryDefaults[operation]:
+                fail("unknown setting retry.{0}.{1}".format(operation, key))
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                fail("retry.{0}.{1} must be a non-negative number".format(operation, key))
+
+    classes = definition['concurrencyClasses']
+    for className, settings in classes.items():
+        if 'lane' not in settings or 'maxWaitSeconds' not in settings:
+            fail("concurrencyClasses.{0} needs 'lane' and 'maxWaitSeconds'".format(className))
+
+    defaults = definition['datasetDefaults']
+    seen = set()
+    for entry in definition['datasets']:
+        if 'name' not in entry:
+            fail("every dataset needs a 'name'")
+
+        name = entry['name']
+        if name in seen:
+            fail("dataset '{0}' is declared twice".format(name))
+        seen.add(name)
+
+        settings = dict(defaults)
+        settings.update(entry)
+
+        for key in ['enabled', 'concurrency', 'ddlTable', 'buckets', 'clusterKey',
+                    'sortKey', 'insertMode', 'format', 'compositeKeys', 'checkRowCounts']:
+            if key not in settings:
+                fail("dataset '{0}' has no '{1}' (and no default)".format(name, key))
+
+        if settings['concurrency'] not in classes:
+            fail("dataset '{0}' uses unknown concurrency class '{1}'".format(name, settings['concurrency']))
+
+        if settings['insertMode'] not in insertModes:
+            fail("dataset '{0}' insertMode must be one of {1}".format(name, sorted(insertModes)))
+
+        if str(settings['format']).upper() not in storageFormats:
+            fail("dataset '{0}' format must be one of {1}".format(name, storageFormats))
+
+        buckets = settings['buckets']
+        if isinstance(buckets, bool) or not isinstance(buckets, int) or buckets < 1:
+            fail("dataset '{0}' buckets must be a positive integer".format(name))
+
+
+_pipeline = None
+
+def load(configFile=None):
+    # Parse and validate the definition once per process
+    global _pipeline
+
+    if configFile is None and _pipeline is not None:
+        return _pipeline
+
+    if configFile is None:
+        configFile = environ.get('AUTOETL_PIPELINE', defaultConfigFile)
+
+    with open(configFile) as f:
+        try:
+            definition = loadJson(f)
+        except ValueError as e:
+            raise PipelineConfigError("{0}: {1}".format(configFile, e))
+
+    validate(definition, configFile)
+
+    _pipeline = Pipeline(definition, configFile)
+    return _pipeline
+
+
+if __name__ == "__main__":
+    # Validate a definition from the command line, e.g.
+    #   python pipeline.py /data/scripts/pipeline.json
+    from sys import argv
+
+    p = load(argv[1] if len(argv) > 1 else None)
+    print("{0}: pipeline '{1}' OK, {2} enabled data sets".format(p.source, p.name,
+                                                                 len(p.enabledDataSets())))
@@ -21,57 +21,118 @@
 #
 
 from sys import argv, stdout
+from os import remove, stat
+
+fullFilePath = argv[1]
+filename = fullFilePath.split('/')[-1]
+
+# Extract the dataset type by dropping
+# the file extension
+dataSetType = filename.split('.')[0]
+
+# Most events in a drop are for files this script
+# ignores, so settle those before importing anything
+# heavy or parsing the table definitions
+
+# Hidden files are scratch space, never data sets
+if filename.startswith('.'):
+    exit(0)
+
+import pipeline
+
+config = pipeline.load()
+
+dataSet = config.dataSet(dataSetType)
+
+if dataSet is None:
+    todoFile = "/".join(fullFilePath.split('/')[:-1]) + "/" + dataSetType + ".todo"
+    try:
+        remove(todoFile)
+    except OSError:
+        pass
+
+    # Quietly ignore the erroneous files
+    exit(0)
+elif filename.split('.')[1] == "todo":
+    exit(0)
+
+# In distributed mode the incrond event only queues
+# the upload, a worker node re-invokes this script
+# with --claimed to actually perform it
+if config.distributed['enabled'] and "--claimed" not in argv:
+    import workqueue
+
+    queue = workqueue.fromConfig(config)
+    fileStatInfo = stat(fullFilePath)
+    queue.enqueueOnce("push-{0}-{1}-{2}".format(fullFilePath, fileStatInfo.st_size,
+                                               int(fileStatInfo.st_mtime)),
+                      'push', {'path': fullFilePath})
+    exit(0)
+
 from datetime import date
-from hashlib import md5
-from chardet.universaldetector import UniversalDetector
 from os.path import isfile
 from os import devnull
 from time import sleep, time
-from azure.storage.blob import BlobService
 from azure.common import AzureMissingResourceHttpError, AzureHttpError 
 from subprocess import Popen, STDOUT, PIPE
-
-metaDir = "/data/meta"
-logRoot = "/data/logs/"
-
-azureAccount = 'plsinsightdata'
-ingestContainer = 'frisco'
-productionContainer = 'plsdevelopment'
+from binascii import hexlify
+from errno import ENOSPC
+from shlex import split as shellSplit
+
+import normalize
+import compress
+import clients
+import space
+import retry
+import metrics
+
+metaDir = config.paths['meta']
+logRoot = config.paths['logs']
+
+azureAccount = config.push['account']
+ingestContainer = config.push['ingestContainer']
+productionContainer = config.push['productionContainer']
+maxConnections = config.push.get('maxConnections', 5)
+
+# How long a completed step is remembered, i.e. how
+# late a re-run of the same delivery can still resume
+ledgerRetentionSeconds = config.push.get('ledgerRetentionSeconds', 604800)
+
+# Optional stream compression of the
+# upload, Hive reads it transparently
+compression = config.push.get('compression', {})
+compressionCodec = compression.get('codec')
 
 # This functionality is being pushed
 # upstream in the ETL process
 #archiveContainer = 'kdunn-test'
 
-azureKeyLocation = '/etc/hadoop/conf/key'
+azureKeyLocation = config.push['keyFile']
+
+hadoopEdgeNode = config.push['hadoopEdgeNode']
+hiveServer2 = config.push['hiveServer2']
+hivePort = config.push['hivePort']
+hiveDatabase = config.push['hiveDatabase']
+tablePrefix = config.push['tablePrefix']
 
-hadoopEdgeNode = "frisco-ssh.azurehdinsight.net"
-hiveServer2 = "hn0-frisco.jmlhoa5f5zfenakxzzq1hcslzh.bx.internal.cloudapp.net"
+# Where the staging external tables' files live in the
+# production container, independent of the database name
+stagePath = config.push['stagePath'].strip('/')
 
-ddlFile = "/data/scripts/tableDefs.json"
-beeline = "env JAVA_HOME=/usr/lib/jvm/java-7-openjdk-amd64 /usr/bin/beeline"
+ddlFile = config.paths['ddlFile']
+beeline = config.push['beeline']
+
+# beeline failures worth another attempt, as opposed
+# to SQL errors which fail the same way every time
+hiveConnectErrors = ["Could not open client transport", "Connection refused",
+                     "Could not establish connection"]
+hiveTransientErrors = hiveConnectErrors + ["TTransportException", "SocketTimeoutException",
+                                           "Read timed out", "Connection reset"]
 
 # This is the path where the data will be staged
 # in the ingest container (i.e. HDFS-visible location)
 # in the HDInsight cluster for Hive external tables
-targetIngestPath = "tmp/hive"
-
-validDataSets = [
-'Allergies',
-'Appointments',
-'Clients',
-'Encounters',
-#'FillRates',
-'Medications',
-'Orders',
-'PatientDemographics',
-'Problems',
-'Providers',
-'Results',
-'Vaccines',
-'Vitals'
-]
-
-
+targetIngestPath = config.push['targetIngestPath']
 
 # This is the full source DDL 
 # (including empty columns)
@@ -85,6 +146,10 @@ def stringClean(theString):
 
 # This DDL excludes the empty columns
 insertDdl = {}
+
+# Column names and types, excluding the empty
+# columns, used to lay out the target table
+targetDdl = {}
 with open(ddlFile) as f:
     allTheFields = f.readlines()
     f.close()
@@ -120,68 +185,82 @@ with open(ddlFile) as f:
         fieldString = ", ".join([v.split()[0] for v in validFields if v != ""])
         insertDdl[stringClean(table)] = fieldString
 
+        fieldString = ", ".join([v.rstrip(",") for v in validFields if v != ""])
+        targetDdl[stringClean(table)] = fieldString
 
-# Make some additional entries since
-# this table differs from its .txt filename
-dataSetDdl["PatientDemographics"] = dataSetDdl["Patients"]
-insertDdl["PatientDemographics"] = insertDdl["Patients"]
-
-def computeMd5EncodingLines(fname):
-    hash = md5()
-    encodingDetector = UniversalDetector()
-    lines = 0
-    with open(fname, "rb") as f:
-        # Read 4096 bytes at a time to
-        # support reading large files
-        for chunk in iter(lambda: f.read(4096), b""):
-            # Tabulate the newlines in this chunk
-            lines = lines + chunk.count('\x0a')
-            encodingDetector.feed(chunk)
-            hash.update(chunk)
-
-    encodingDetector.close()
-    encoding = "{0}-{1}".format(encodingDetector.result['encoding'], str(encodingDetector.result['confidence']))
-    return hash.digest(), encoding, lines
 
-fullFilePath = argv[1]
-filename = fullFilePath.split('/')[-1]
-
-# Extract the dataset type by dropping
-# the file extension
-dataSetType = filename.split('.')[0]
-
-if dataSetType not in validDataSets:
-    todoFile = "/".join(fullFilePath.split('/')[:-1]) + "/" + dataSetType + ".todo"
-    t = Popen("rm -f {0}".format(todoFile).split())
-    t.wait()
-
-    # Quietly ignore the erroneous files
-    exit(0)
-elif filename.split('.')[1] == "todo":
-    exit(0)
+# Make some additional entries for data sets
+# which differ from their table definition name
+for d in config.enabledDataSets():
+    if d.ddlTable != d.name:
+        dataSetDdl[d.name] = dataSetDdl[d.ddlTable]
+        insertDdl[d.name] = insertDdl[d.ddlTable]
+        targetDdl[d.name] = targetDdl[d.ddlTable]
 
 # Prevent load concurrency 
-# Hive doesn't seem to like getting slammed
-bigSets = ['Appointments', 'Encounters', 'Medications', 'Orders', 'PatientDemographics', 'Problems', 'Results', 'Vitals']
-#if dataSetType in bigSets:
-previousSet = ""
-if dataSetType in validDataSets[1:]:
-    previousSet = validDataSets[validDataSets.index(dataSetType) - 1]
-previousTodoFile = "/".join(fullFilePath.split('/')[:-1]) + "/" + previousSet + ".todo"
+# Hive doesn't seem to like getting slammed,
+# so loads in the same concurrency lane queue
+# up behind one another in pipeline order
+predecessors = config.lanePredecessors(dataSetType) + ["", ""]
+previousSet, twoPreviousSet = predecessors[0], predecessors[1]
 
-twoPreviousSet = ""
-if dataSetType in validDataSets[2:]:
-    twoPreviousSet = validDataSets[validDataSets.index(dataSetType) - 2]
+previousTodoFile = "/".join(fullFilePath.split('/')[:-1]) + "/" + previousSet + ".todo"
 twoPreviousTodoFile = "/".join(fullFilePath.split('/')[:-1]) + "/" + twoPreviousSet + ".todo"
 
 # Relocating this to allow checkums
 # to be computed before sleeping 
-# between loads
-md5Checksum, encoding, countedRows = computeMd5EncodingLines(fullFilePath)
+# between loads. Non UTF-8 data is
+# transcoded in the same pass.
+normalizeSettings = config.push.get('normalize', {})
+try:
+    # Transcoding writes a second copy beside the original
+    # before swapping it in, so hold room for it as unpack.py
+    # does for the extraction
+    reservation = None
+    if normalizeSettings.get('transcode', True):
+        loadingDir = "/".join(fullFilePath.split('/')[:-1])
+        sizeInBytes = stat(fullFilePath).st_size
+
+        reservation = space.reserve(loadingDir, sizeInBytes, filename)
+        if reservation is None:
+            # Make room from artifacts past their retention
+            space.purge()
+            reservation = space.reserve(loadingDir, sizeInBytes, filename)
+        if reservation is None:
+            raise IOError(ENOSPC, "No space to transcode {0} bytes".format(sizeInBytes))
+
+    try:
+        md5Checksum, encoding, countedRows = normalize.normalizeFile(fullFilePath,
+                                                                     sampleBytes=normalizeSettings.get('sampleBytes', 65536),
+                                                                     fallbackEncoding=normalizeSettings.get('fallbackEncoding', 'windows-1252'),
+                                                                     errors=normalizeSettings.get('errors', 'replace'),
+                                                                     transcode=normalizeSettings.get('transcode', True))
+    finally:
+        if reservation is not None:
+            space.release(reservation)
+except (UnicodeError, IOError, OSError) as e:
+    # Undecodable under errors=strict, or out of space while
+    # transcoding; nothing can be loaded, so record the run
+    # and free the lane as a finished load would
+    result = "Normalize-Failed:" + str(e).split(".")[0]
+
+    runId = metrics.begin(config.metrics, 'push', filename, dataSetType)
+    metrics.end(config.metrics, runId, result)
+
+    theFile = open(metaDir + '/insert', 'a')
+    theFile.write("{0},0,{1},,,,{2}\n".format(int(time()), filename, result))
+    theFile.close()
 
-# Wait until the previous big load completes
+    try:
+        remove("/".join(fullFilePath.split('/')[:-1]) + "/" + dataSetType + ".todo")
+    except OSError:
+        pass
+    exit(1)
+
+# Wait until the previous big load completes, a
+# worker only claims a push once it is its turn
 startOfWaiting = int(time())
-while isfile(previousTodoFile):
+while "--claimed" not in argv and isfile(previousTodoFile):
     # The waiting clock starts over if
     # we're behind a load in progress
     # AND a queued load
@@ -189,7 +268,7 @@ while isfile(previousTodoFile):
         startOfWaiting = int(time())
 
     # If the previous load hangs too long, stop waiting
-    if (int(time()) - startOfWaiting) >= 12000:
+    if (int(time()) - startOfWaiting) >= config.maxWaitSeconds(dataSetType):
         break
     sleep(10)
 
@@ -200,7 +279,10 @@ logFile = logRoot + "/push-{0}.log".format(dataSetType + "-" + str(startTime))
 
 theLog = open(logFile, 'w+')
 
+runId = metrics.begin(config.metrics, 'push', filename, dataSetType)
+
 theLog.write("Beginning ouput log\n")
+theLog.write("Encoding: {0}\n".format(encoding))
 theLog.flush()
 
 # Get the full file path by stripping
@@ -213,7 +295,7 @@ rowCountFullFilePath = "/".join(fullFilePath.split('/')[:-1]) + "/RowCounts.txt"
 doesMatch = False
 
 
-if dataSetType != "Clients":
+if dataSet.checkRowCounts:
     # Wait until row count file has also landed
     while True:
         if isfile(rowCountFullFilePath):
@@ -229,10 +311,10 @@ if dataSetType != "Clients":
     # Loop through all the record counts
     for c in allCounts:
         # Split the lines on the delimiter
-        dataSet, expectedRows = c.split("|")
+        countedSet, expectedRows = c.split("|")
 
         # Find the data set of interest
-        if dataSet == dataSetType:
+        if countedSet == dataSetType:
             # Compare the records (excluding header row)
             doesMatch = (int(expectedRows) == int(countedRows - 1))
             break
@@ -240,20 +322,29 @@ if dataSetType != "Clients":
 result = None
             
 # Only proceed if we have a valid data or metadata file
-if doesMatch or dataSetType == "Clients":
+if doesMatch or not dataSet.checkRowCounts:
 
     theLog.write("Record counts match, proceeding with load\n\n")
     theLog.flush()
 
-    # Read in the Azure account key from
-    # the super secret location
-    accountKeyFile = open(azureKeyLocation, 'r')
-    accountKey = accountKeyFile.read().strip()
-    accountKeyFile.close()
+    # Log every backoff so slow loads can be explained
+    def logRetry(operation, attempt, delay, e):
+        theLog.write("Retrying {0} (attempt {1}) in {2:.1f}s after: {3}\n".format(operation, attempt,
+                                                                                  delay, str(e)))
+        theLog.flush()
 
-    # Get a handle on the Azure Blob Storage account
-    azureStorage = BlobService(account_name=azureAccount, 
-                               account_key=accountKey)
+    retryPolicies = retry.policies(config, onRetry=logRetry)
+
+    # Steps already completed for this exact delivery (same
+    # file, checksum and modification time) by an earlier
+    # run are skipped rather than repeated
+    ledger = retry.Ledger(metaDir + "/idempotency")
+    ledger.purge(ledgerRetentionSeconds)
+    deliveryKey = (fullFilePath, stat(fullFilePath).st_mtime, hexlify(md5Checksum))
+
+    # Get a handle on the Azure Blob Storage account,
+    # borrowed from the agent when one is running
+    azureStorage = clients.blobService(azureAccount, azureKeyLocation, config.agent)
 
     # Create a datestring for the filenames
     dateString = date.today().strftime("%Y%m%d")
@@ -264,141 +355,255 @@ if doesMatch or dataSetType == "Clients":
     # Create full paths for the location
     targetIngestFullPath = "{0}/{1}.txt".format(targetIngestPath, targetFile)
 
-    # Ensure a clean slate for pushing the new data set
-    try:
-        azureStorage.delete_blob(ingestContainer, targetIngestFullPath)
-        theLog.write("Existing ingest blob found, deleting it\n\n")
-        theLog.flush()
-    except AzureMissingResourceHttpError:
-        pass
-
-    # Try to put the blob out in the wild, provide MD5 for error
-    # checking since M$ didn't feel the need to implement a return
-    # code for this function
-
-    # On further testing, the "content_md5" is only for header rather
-    # than the actual blob content - have to wait for these APIs to mature
+    # Hive chooses the decompression codec by file extension,
+    # so LOAD DATA must reference e.g. Allergies20151103.txt.gz
+    if compressionCodec is not None:
+        targetIngestFullPath = targetIngestFullPath + compress.extensions[compressionCodec]
+
+    # Lets status.py show the rate of a long upload
+    # while it is still under way
+    uploadProgress = metrics.Progress(config.metrics, runId, targetIngestFullPath, dataSetType)
+
+    def replaceIngestBlob():
+        # Ensure a clean slate for pushing the new data set
+        try:
+            retryPolicies['delete'].run(azureStorage.delete_blob, ingestContainer, targetIngestFullPath)
+            theLog.write("Existing ingest blob found, deleting it\n\n")
+            theLog.flush()
+        except AzureMissingResourceHttpError:
+            pass
+
+        # Uploads go block by block, a failed block is
+        # retried on its own
+        if compressionCodec is not None:
+            return compress.uploadCompressed(azureStorage,
+                                             ingestContainer,
+                                             targetIngestFullPath,
+                                             fullFilePath,
+                                             codec=compressionCodec,
+                                             level=compression.get('level', 6),
+                                             workers=compression.get('workers', 4),
+                                             retryPolicy=retryPolicies['upload'],
+                                             progress=uploadProgress)
+
+        # On further testing, the "content_md5" is only for header rather
+        # than the actual blob content - have to wait for these APIs to mature
+        compress.uploadFile(azureStorage,
+                            ingestContainer,
+                            targetIngestFullPath,
+                            fullFilePath,
+                            #content_md5=md5Checksum.encode('base64').strip(),
+                            connections=maxConnections,
+                            retryPolicy=retryPolicies['upload'],
+                            progress=uploadProgress)
+
+    uploaded = False
     try:
-        azureStorage.put_block_blob_from_path(ingestContainer,
-                                              targetIngestFullPath,
-                                              fullFilePath,
-                                              #content_md5=md5Checksum.encode('base64').strip(),
-                                              max_connections=5)
-        theLog.write("Uploaded blob to ingest container : {0}\n".format(ingestContainer))
+        uploadStarted = time()
+        skipped, compressionStats = ledger.once(ledger.key("upload", targetIngestFullPath, *deliveryKey),
+                                                targetIngestFullPath, replaceIngestBlob)
+        uploaded = True
+
+        if skipped:
+            theLog.write("Blob already uploaded by an earlier run : {0}\n".format(targetIngestFullPath))
+        else:
+            theLog.write("Uploaded blob to ingest container : {0}\n".format(ingestContainer))
+            sentBytes = stat(fullFilePath).st_size
+            if compressionCodec is not None:
+                sentBytes = compressionStats['wireBytes']
+            metrics.timing(config.metrics, runId, 'upload', targetIngestFullPath, time() - uploadStarted,
+                           dataset=dataSetType, sizeInBytes=sentBytes)
+
+        if not skipped and compressionCodec is not None:
+            # Record what the CPU bought us on the wire
+            theLog.write("Compressed upload {0}\n".format(compress.describe(compressionStats)))
+
+            theFile = open(metaDir + '/compress', 'a')
+            theFile.write("{0},{1},{2},{3},{4},{5},{6:.2f},{7:.2f}\n".format(int(time()), filename,
+                                                                           compressionStats['codec'],
+                                                                           compressionStats['level'],
+                                                                           compressionStats['rawBytes'],
+                                                                           compressionStats['wireBytes'],
+                                                                           compressionStats['cpuSeconds'],
+                                                                           compressionStats['wallSeconds']))
+            theFile.close()
         theLog.flush()
-    except AzureHttpError as e:
-        result = "Ingest-Failed:" + e.message.split(".")[0]
+    except (AzureHttpError, IOError, OSError, clients.AgentError) as e:
+        result = "Ingest-Failed:" + str(e).split(".")[0]
         theLog.write("Upload exception: {0}\n\n".format(result))
         theLog.flush()
 
 
-    # Create a list of queries for Hive
-    hiveQueries = []
-
-    sortedByString = "SORTED BY(GenPatientID)"
-    if dataSetType == "Clients" or dataSetType == "Providers":
-        sortedByString = ""
-
-    # Create a template external table
-    # and populate it with specifics
-    # for a given data set type
-    hiveCreateExtTable =\
-    """
-    DROP TABLE pls.kdunn_{dType}_stg ; \n
-    CREATE EXTERNAL TABLE pls.kdunn_{dType}_stg 
-    ( {ddl} )
-    CLUSTERED BY(GenClientID) {sortString} INTO 32 BUCKETS 
-    ROW FORMAT DELIMITED FIELDS TERMINATED BY '|' 
-    STORED AS TEXTFILE LOCATION 'wasb://{container}@{account}/pls/stage/{dType}' 
-    TBLPROPERTIES("skip.header.line.count"="1");
-    """.format(dType=dataSetType, 
-               ddl=dataSetDdl[dataSetType],
-               sortString=sortedByString,
-               container=productionContainer, 
-               account=azureAccount + ".blob.core.windows.net")
-               #path=targetIngestFullPath)
-
-    hiveQueries.append(hiveCreateExtTable)
-
-    insertMode = "INSERT INTO TABLE"
-    if dataSetType in ['Providers', 'PatientDemographics', 'Clients']:
-        # These data sources are full-extracts, truncate before load
-        insertMode = "INSERT OVERWRITE TABLE"
-
-    loadStgQuery = "LOAD DATA INPATH '/{path}' INTO TABLE pls.kdunn_{t}_stg ;".format(path=targetIngestFullPath,
-                                                                                      t=dataSetType)
-    hiveQueries.append(loadStgQuery)
-
-    compositePatientField = " concat(cast(GenClientID as STRING), '-', cast(GenPatientID as STRING)) as PatientID"
-    insertColumns = insertDdl[dataSetType].replace(" PatientID", compositePatientField)
-
-    if dataSetType in ["PatientDemographics", "Providers"]:
-        compositeProviderField = " concat(cast(GenClientID as STRING), '-', cast(GenProviderID as STRING)) as ProviderID"
-        insertColumns = insertColumns.replace(" ProviderID", compositeProviderField)
-        
-    loadDevQuery = "{insertMode} pls.kdunn_{d}_dev SELECT {c} FROM pls.kdunn_{d}_stg ;".format(insertMode=insertMode,
-                                                                                               d=dataSetType,
-                                                                                               c=insertColumns)
-    hiveQueries.append(loadDevQuery)
-
-    hiveQueries.append("SELECT COUNT(*) FROM pls.kdunn_{0}_stg ;".format(dataSetType))
-
-    # Hide SSH output
-    devNull = open(devnull)
-
-    theLog.write("Opening SSH tunnel to edge node {0}\n\n".format(hadoopEdgeNode))
-
-    # Open a secure tunnel to channel the beeline
-    # connection through
-    ssh = Popen(["ssh", "-4", hadoopEdgeNode, "-L10001:{hs2}:10001".format(hs2=hiveServer2), "-N"],
-                stdout=devNull, stderr=theLog)
-
-    theLog.write("\n\n")
-    theLog.flush()
-
-    # Call out to Popen() and have a beeline Hive client execute
-    # the CREATE EXTERNAL TABLE and do an INSERT INTO ... SELECT * FROM ...
-    p = Popen(beeline, shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-
-    # Note: Azure's HiveServer2 default config seems to only allow HTTP 
-    # transport mode, this is unfortunate since the major Python-Thrift 
-    # connector (PyHive) would have been useful rather than using Popen + beeline
-    hiveConnectString = "!connect jdbc:hive2://localhost:10001/pls;transportMode=http {u} {p}".format(u="etl",
-                                                                                                      p="etl")
-
-    hiveCommands = "\n".join([hiveConnectString] + hiveQueries + ['!exit'])
-
-    # Initiate the connection
-    hiveCli = p.communicate # as hiveCli:
-    stdout, stderr = hiveCli(hiveCommands)
-    theLog.write("Connecting to Hiveserver2: " + hiveConnectString + "\n")
-    theLog.flush()
+    # Nothing to load if the upload failed
+    if uploaded:
+        # Create a list of queries for Hive
+        hiveQueries = []
+
+        stagingTable = "{db}.{prefix}{d}_stg".format(db=hiveDatabase, prefix=tablePrefix, d=dataSetType)
+        targetTable = "{db}.{prefix}{d}_dev".format(db=hiveDatabase, prefix=tablePrefix, d=dataSetType)
+
+        # Create a template external table
+        # and populate it with specifics
+        # for a given data set type
+        hiveCreateExtTable =\
+        """
+        DROP TABLE {table} ; \n
+        CREATE EXTERNAL TABLE {table} 
+        ( {ddl} )
+        {layout} 
+        ROW FORMAT DELIMITED FIELDS TERMINATED BY '|' 
+        STORED AS TEXTFILE LOCATION 'wasb://{container}@{account}/{stage}/{dType}' 
+        TBLPROPERTIES("skip.header.line.count"="1");
+        """.format(table=stagingTable,
+                   dType=dataSetType, 
+                   ddl=dataSetDdl[dataSetType],
+                   layout=dataSet.layoutClause(),
+                   stage=stagePath,
+                   container=productionContainer, 
+                   account=azureAccount + ".blob.core.windows.net")
+                   #path=targetIngestFullPath)
+
+        hiveQueries.append(hiveCreateExtTable)
+
+        # The target table only takes its bucketing
+        # and storage format from the pipeline when
+        # it doesn't exist yet
+        hiveCreateTargetTable =\
+        """
+        CREATE TABLE IF NOT EXISTS {table} 
+        ( {ddl} )
+        {layout} 
+        STORED AS {format};
+        """.format(table=targetTable,
+                   ddl=targetDdl[dataSetType],
+                   layout=dataSet.layoutClause(),
+                   format=dataSet.format)
+
+        hiveQueries.append(hiveCreateTargetTable)
+
+        insertMode = dataSet.insertStatement()
+
+        loadStgQuery = "LOAD DATA INPATH '/{path}' INTO TABLE {t} ;".format(path=targetIngestFullPath,
+                                                                            t=stagingTable)
+        hiveQueries.append(loadStgQuery)
+
+        # Composite keys are qualified with the client, e.g.
+        # concat(cast(GenClientID as STRING), '-', cast(GenPatientID as STRING)) as PatientID
+        insertColumns = insertDdl[dataSetType]
+        for key in dataSet.compositeKeys:
+            compositeField = " concat(cast(GenClientID as STRING), '-', cast(Gen{k} as STRING)) as {k}".format(k=key)
+            insertColumns = insertColumns.replace(" " + key, compositeField)
+
+        loadDevQuery = "{insertMode} {t} SELECT {c} FROM {s} ;".format(insertMode=insertMode,
+                                                                       t=targetTable,
+                                                                       s=stagingTable,
+                                                                       c=insertColumns)
+        hiveQueries.append(loadDevQuery)
+
+        # Rows now in the staging table, the load's result
+        countQuery = "SELECT COUNT(*) FROM {0} ;".format(stagingTable)
+
+        # Hide SSH output
+        devNull = open(devnull)
+
+        # Reuse the agent's standing tunnel if there is one
+        ssh = None
+        if clients.hiveTunnel(config.agent, hadoopEdgeNode, hiveServer2, hivePort):
+            theLog.write("Using agent SSH tunnel to edge node {0}\n\n".format(hadoopEdgeNode))
+        else:
+            theLog.write("Opening SSH tunnel to edge node {0}\n\n".format(hadoopEdgeNode))
+
+            # Open a secure tunnel to channel the beeline
+            # connection through
+            ssh = Popen(["ssh", "-4", hadoopEdgeNode, "-L{port}:{hs2}:{port}".format(hs2=hiveServer2, port=hivePort), "-N"],
+                        stdout=devNull, stderr=theLog)
+
+        theLog.write("\n\n")
+        theLog.flush()
 
-    # Execute the loading process (finally)
-    for q in hiveQueries:
-        theLog.write("Executing Hive query: \n")
-        theLog.write(q + "\n")
+        # Note: Azure's HiveServer2 default config seems to only allow HTTP 
+        # transport mode, this is unfortunate since the major Python-Thrift 
+        # connector (PyHive) would have been useful rather than using Popen + beeline
+        hiveJdbcUrl = "jdbc:hive2://localhost:{port}/{db};transportMode=http".format(port=hivePort,
+                                                                                    db=hiveDatabase)
+        theLog.write("Connecting to Hiveserver2: " + hiveJdbcUrl + "\n")
         theLog.flush()
 
-    theLog.write("Exited Beeline CLI\n")
-    theLog.flush()
-        
-    # Wait for the beeline shell
-    # to gracefully exit
-    p.wait()
+        def runHive(statement, retryMarkers):
+            # One beeline session per statement, so a failure
+            # is retried from that statement rather than the top
+            command = shellSplit(beeline) + ["-u", hiveJdbcUrl,
+                                             "-n", config.push['hiveUser'],
+                                             "-p", config.push['hivePassword'],
+                                             "--silent=true", "--showHeader=false",
+                                             "--outputformat=tsv2", "-e", statement]
+
+            started = time()
+            p = Popen(command, stdout=PIPE, stderr=PIPE)
+            stdout, stderr = p.communicate()
+            failed = p.returncode != 0 or "Error:" in stderr
+
+            # e.g. "LOAD DATA" or "INSERT OVERWRITE"
+            metrics.timing(config.metrics, runId, 'hive', " ".join(statement.split()[:2]).upper(),
+                           time() - started, dataset=dataSetType, ok=not failed)
+
+            theLog.write("OUT:" + stdout + "\n")
+            theLog.write("ERR:" + stderr + "\n")
+            theLog.flush()
+
+            if failed:
+                transient = any(marker in stderr for marker in retryMarkers)
+                raise retry.HiveError(stderr.strip().split("\n")[-1], transient)
+            return stdout
+
+        # Execute the loading process (finally)
+        loaded = False
+        try:
+            for q in hiveQueries:
+                theLog.write("Executing Hive query: \n")
+                theLog.write(q + "\n")
+                theLog.flush()
+
+                # LOAD DATA moves the blob away and an appending INSERT
+                # may already have committed, so if either lost its
+                # connection only retry it if it never reached HiveServer2
+                retryMarkers = hiveTransientErrors
+                if q is loadStgQuery or (q is loadDevQuery and dataSet.insertMode == 'append'):
+                    retryMarkers = hiveConnectErrors
+
+                skipped, out = ledger.once(ledger.key("hive", q, *deliveryKey), q.split()[0],
+                                           retryPolicies['hive'].run, runHive, q, retryMarkers)
+                if skipped:
+                    theLog.write("Already executed by an earlier run, skipping\n")
+                    theLog.flush()
+
+            # The INSERT succeeded (now or in an earlier run)
+            loaded = True
+
+            stdout = retryPolicies['hive'].run(runHive, countQuery, hiveTransientErrors)
+            result = stdout.strip().split("\n")[-1].strip()
+        except retry.HiveError as e:
+            result = "Hive-Failed:" + str(e).split(".")[0]
+            theLog.write("Hive exception: {0}\n\n".format(result))
+            theLog.flush()
+
+        theLog.write("Exited Beeline CLI\n")
+        theLog.flush()
 
-    # Close the tunnel
-    ssh.terminate()
-    ssh.wait()
+        # Close the tunnel, unless it's the agent's
+        if ssh is not None:
+            ssh.terminate()
+            ssh.wait()
 
-    devNull.close()
+        devNull.close()
 
-    theLog.write("OUT:" + stdout + "\n")
-    theLog.flush()
-    theLog.write("ERR:" + stderr + "\n")
-    theLog.flush()
-
-    result = stdout.split("\n")[-3].split()[1]
+        # Hive holds every row now, so the extracted file falls
+        # under the retention policy. This only records it, any
+        # compaction happens later in space.py purge (cron).
+        if loaded:
+            space.confirm(fullFilePath, 'loading')
+            theLog.write("Handed {0} to retention\n".format(fullFilePath))
+            theLog.flush()
 
     # Archive it as well -- TODO relocate this functionality to
     # earlier in the ETL process, entire ZIP archives will be created
@@ -437,14 +642,23 @@ theFile = open(metaDir + '/insert', 'a')
 theFile.write(record)
 theFile.close()
 
+metrics.end(config.metrics, runId, result)
+
 # Remove this data's todo file
 todoFile = "/".join(fullFilePath.split('/')[:-1]) + "/" + dataSetType + ".todo"
-t = Popen("rm -f {0}".format(todoFile).split())
-t.wait()
+try:
+    remove(todoFile)
+except OSError:
+    pass
 
 theLog.write("\n\npush.py finished for {0}\n".format(dataSetType))
 theLog.close()
 
+# A failed upload or Hive load exits non-zero, so in
+# distributed mode the worker retries it (see worker.py)
+if str(result).startswith(("Ingest-Failed", "Hive-Failed")):
+    exit(1)
+
 
 # List all containers in this account
 """
@@ -0,0 +1,141 @@
+#
+#       Retry policies and idempotency keys for
+#       blob and Hive operations
+#
+#       Author: Kyle Dunn (kdunn[9][2][6][@]gmail)
+#               (c) Dunn Infinite Designs LLC (2015)
+#
+#       Each kind of operation (upload, delete, hive) has its own
+#       policy: a number of attempts, a jittered exponential
+#       backoff and a total time budget. Only failures that look
+#       transient are retried, and callers retry the smallest
+#       unit that failed (one block, one statement).
+#
+#       The ledger records completed steps under an idempotency
+#       key, so re-running push.py on the same delivery resumes
+#       after the last step that succeeded instead of repeating
+#       it (e.g. it won't LOAD DATA a blob Hive already moved).
+#
+
+from os import makedirs, listdir, remove, stat, open as osOpen, write, close, O_CREAT, O_EXCL, O_WRONLY
+from os.path import join, isdir, exists
+from hashlib import sha1
+from random import uniform
+from socket import error as socketError
+from errno import ENOENT, EACCES, EISDIR
+from time import sleep, time
+
+# HTTP statuses worth another attempt
+transientStatusCodes = [408, 429, 500, 502, 503, 504]
+
+
+class HiveError(Exception):
+
+    def __init__(self, message, transient):
+        super(HiveError, self).__init__(message)
+        self.transient = transient
+
+
+def isTransient(e):
+    if isinstance(e, HiveError):
+        return e.transient
+
+    # AzureHttpError, directly or relayed by the agent
+    statusCode = getattr(e, 'status_code', None)
+    if statusCode is not None:
+        return statusCode in transientStatusCodes
+
+    # Local file problems won't fix themselves
+    if getattr(e, 'errno', None) in (ENOENT, EACCES, EISDIR):
+        return False
+
+    # Dropped connections and timeouts, including
+    # requests' exceptions (which are IOErrors)
+    return isinstance(e, (socketError, IOError, OSError, EOFError))
+
+
+class Policy(object):
+
+    def __init__(self, name, attempts, baseDelay, maxDelay, budgetSeconds, onRetry=None):
+        self.name = name
+        self.attempts = attempts
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.budgetSeconds = budgetSeconds
+        self.onRetry = onRetry
+
+    def delay(self, attempt):
+        # "Full jitter" keeps many workers that failed
+        # together from retrying in lockstep
+        return uniform(0, min(self.maxDelay, self.baseDelay * 2 ** (attempt - 1)))
+
+    def run(self, fn, *args, **kwargs):
+        started = time()
+        attempt = 0
+
+        while True:
+            attempt = attempt + 1
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if not isTransient(e) or attempt >= self.attempts:
+                    raise
+
+                delay = self.delay(attempt)
+                if time() - started + delay > self.budgetSeconds:
+                    raise
+
+                if self.onRetry is not None:
+                    self.onRetry(self.name, attempt, delay, e)
+                sleep(delay)
+
+
+def policies(config, onRetry=None):
+    settings = config.retry
+    return dict((name, Policy(name, onRetry=onRetry, **settings[name])) for name in settings)
+
+
+class Ledger(object):
+
+    def __init__(self, ledgerDir):
+        self.ledgerDir = ledgerDir
+        if not isdir(ledgerDir):
+            try:
+                makedirs(ledgerDir)
+            except OSError:
+                pass
+
+    def key(self, *parts):
+        return sha1("|".join(str(p) for p in parts).encode('utf-8')).hexdigest()
+
+    def isDone(self, key):
+        return exists(join(self.ledgerDir, key))
+
+    def record(self, key, note=""):
+        try:
+            fd = osOpen(join(self.ledgerDir, key), O_CREAT | O_EXCL | O_WRONLY)
+        except OSError:
+            return
+        write(fd, "{0} {1}\n".format(int(time()), note).encode('utf-8'))
+        close(fd)
+
+    def once(self, key, note, fn, *args, **kwargs):
+        # Run fn unless a previous run already completed
+        # this step; returns (skipped, result)
+        if self.isDone(key):
+            return True, None
+
+        result = fn(*args, **kwargs)
+        self.record(key, note)
+        return False, result
+
+    def purge(self, olderThanSeconds):
+        # Steps old enough that their delivery
+        # won't be re-run any more
+        cutoff = time() - olderThanSeconds
+        for name in listdir(self.ledgerDir):
+            try:
+                if stat(join(self.ledgerDir, name)).st_mtime < cutoff:
+                    remove(join(self.ledgerDir, name))
+            except OSError:
+                pass
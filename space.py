@@ -0,0 +1,322 @@
+#!/usr/bin/python
+#
+#       Disk space management for the staging
+#       and loading directories
+#
+#       Author: Kyle Dunn (kdunn[9][2][6][@]gmail)
+#               (c) Dunn Infinite Designs LLC (2015)
+#
+#       unpack.py reserves the expanded size of an archive
+#       before extracting it, so a delivery that can't fit
+#       fails up front instead of part way through 7z. Once
+#       a stage has confirmed an artifact (the archive fully
+#       extracted, a data set loaded into Hive) it is handed
+#       to the retention ledger. Confirming only records it;
+#       purge (from cron, or when a reservation falls short)
+#       compacts or deletes it according to the pipeline's
+#       retention policy, off the stages' critical path. An
+#       entry is only acted on while the file at its path is
+#       still the one confirmed, a later delivery reusing the
+#       name is left alone.
+#
+#       Show current usage, or apply the retention policy
+#       (e.g. from cron):
+#
+#               $ python /data/scripts/space.py
+#               $ python /data/scripts/space.py purge
+#
+
+from os import statvfs, stat, listdir, remove, rename, kill, getpid, makedirs
+from os.path import join, isdir, dirname, basename
+from json import dumps, loads
+from socket import gethostname
+from time import time
+from uuid import uuid4
+from fcntl import flock, LOCK_EX, LOCK_UN
+from gzip import GzipFile
+from shutil import copyfileobj
+
+import pipeline
+
+config = pipeline.load()
+settings = config.space
+
+spaceDir = join(config.paths['meta'], "space")
+reservationDir = join(spaceDir, "reservations")
+retainedDir = join(spaceDir, "retained")
+
+for d in [reservationDir, retainedDir]:
+    if not isdir(d):
+        try:
+            makedirs(d)
+        except OSError:
+            pass
+
+
+class _Locked(object):
+    # Serializes reservations across processes so two
+    # extractions can't both claim the same free space
+    # (and purges, so two can't compact the same file)
+
+    def __init__(self, name="lock"):
+        self.name = name
+
+    def __enter__(self):
+        self.f = open(join(spaceDir, self.name), 'a')
+        flock(self.f, LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        flock(self.f, LOCK_UN)
+        self.f.close()
+
+
+def _readJson(path):
+    try:
+        with open(path) as f:
+            return loads(f.read())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _writeJson(path, body):
+    tmpPath = join(spaceDir, "." + uuid4().hex)
+    with open(tmpPath, 'w') as f:
+        f.write(dumps(body))
+    rename(tmpPath, path)
+
+
+def isAlive(host, pid):
+    # Whether a process is still running, processes on
+    # other nodes are assumed to be (callers expire them
+    # by age instead, e.g. the reservation TTL)
+    if host != gethostname():
+        return True
+    try:
+        kill(pid, 0)
+        return True
+    except OSError:
+        return False
+
+
+def freeBytes(path):
+    s = statvfs(path)
+    return s.f_bavail * s.f_frsize
+
+
+def activeReservations():
+    # Reservations whose owner is still running
+    # and which haven't outlived the TTL
+    now = time()
+    active = []
+    for name in listdir(reservationDir):
+        path = join(reservationDir, name)
+        reservation = _readJson(path)
+        if reservation is None:
+            continue
+
+        expired = now - reservation['created'] > settings['reservationTtlSeconds']
+        if expired or not isAlive(reservation['host'], reservation['pid']):
+            try:
+                remove(path)
+            except OSError:
+                pass
+            continue
+
+        reservation['id'] = name
+        active.append(reservation)
+    return active
+
+
+def reserve(path, sizeInBytes, owner):
+    # Returns a reservation id, or None if the space
+    # (plus headroom) isn't available on path's filesystem
+    device = stat(path).st_dev
+
+    with _Locked():
+        reserved = sum(r['bytes'] for r in activeReservations() if r['device'] == device)
+        available = freeBytes(path) - reserved - settings['headroomBytes']
+
+        if sizeInBytes > available:
+            return None
+
+        reservationId = uuid4().hex
+        _writeJson(join(reservationDir, reservationId),
+                   {'path': path, 'device': device, 'bytes': sizeInBytes, 'owner': owner,
+                    'host': gethostname(), 'pid': getpid(), 'created': time()})
+        return reservationId
+
+
+def release(reservationId):
+    try:
+        remove(join(reservationDir, reservationId))
+    except OSError:
+        pass
+
+
+def _compact(path):
+    # Gzip next to the original under a hidden name,
+    # which the incrond-triggered stages ignore. Only
+    # kept for a few hours, so favour speed over size.
+    # Returns None if there's no room for the copy.
+    target = join(dirname(path), "." + basename(path) + ".gz")
+    tmpPath = target + ".part"
+
+    # At worst the copy is as large as the original
+    reservation = reserve(dirname(path), stat(path).st_size, "compact " + basename(path))
+    if reservation is None:
+        return None
+
+    try:
+        with open(path, 'rb') as src:
+            out = GzipFile(tmpPath, 'wb', compresslevel=1)
+            try:
+                copyfileobj(src, out, 1048576)
+            finally:
+                out.close()
+
+        rename(tmpPath, target)
+    except (IOError, OSError):
+        _delete(tmpPath)
+        raise
+    finally:
+        release(reservation)
+
+    remove(path)
+    return target
+
+
+def _delete(path):
+    try:
+        remove(path)
+    except OSError:
+        pass
+
+
+def _identity(path):
+    # Enough to tell a file from a later one under the
+    # same name, or None if there's nothing there
+    try:
+        s = stat(path)
+    except OSError:
+        return None
+    return [s.st_ino, s.st_size, s.st_mtime]
+
+
+def _matches(entry):
+    # Whether the file at entry's path is the one confirmed
+    # (entries recorded before identities always match)
+    current = _identity(entry['path'])
+    if current is None:
+        return False
+    return 'identity' not in entry or entry['identity'] == current
+
+
+def confirm(path, stage):
+    # A stage is done with this artifact, record it
+    # for purge() to retain per policy
+    policy = settings['retention'][stage]
+
+    _writeJson(join(retainedDir, uuid4().hex),
+               {'path': path, 'stage': stage, 'confirmed': time(), 'identity': _identity(path),
+                'compact': policy['action'] == 'compact' and policy['keepHours'] > 0,
+                'purgeAfter': time() + policy['keepHours'] * 3600})
+
+
+def retained():
+    entries = []
+    for name in listdir(retainedDir):
+        entry = _readJson(join(retainedDir, name))
+        if entry is not None:
+            entry['id'] = name
+            entries.append(entry)
+    return entries
+
+
+def purge(force=False):
+    # Compact retained artifacts as policy asks and delete
+    # those past retention (or all of them, when space has
+    # run out)
+    with _Locked("purge.lock"):
+        return _purge(force)
+
+
+def _purge(force):
+    freed = 0
+    now = time()
+    for entry in retained():
+        # Gone, or replaced by a newer delivery of the
+        # same name which isn't ours to touch
+        if not _matches(entry):
+            _delete(join(retainedDir, entry['id']))
+            continue
+
+        if not force and entry['purgeAfter'] > now:
+            if entry.get('compact'):
+                before = stat(entry['path']).st_size
+                try:
+                    compacted = _compact(entry['path'])
+                except (IOError, OSError):
+                    continue
+                if compacted is None:
+                    continue
+
+                freed = freed + before - stat(compacted).st_size
+                entry['path'] = compacted
+                entry['identity'] = _identity(compacted)
+                entry['compact'] = False
+                entryId = entry.pop('id')
+                _writeJson(join(retainedDir, entryId), entry)
+            continue
+
+        try:
+            freed = freed + stat(entry['path']).st_size
+        except OSError:
+            pass
+
+        _delete(entry['path'])
+        _delete(join(retainedDir, entry['id']))
+    return freed
+
+
+def usage():
+    # Per-directory view of the filesystem, outstanding
+    # reservations and what retention still holds on to
+    reservations = activeReservations()
+    held = retained()
+
+    report = []
+    for stage in ['staging', 'loading']:
+        path = config.paths[stage]
+        s = statvfs(path)
+        device = stat(path).st_dev
+
+        retainedBytes = 0
+        for entry in held:
+            if entry['stage'] == stage and _matches(entry):
+                retainedBytes = retainedBytes + stat(entry['path']).st_size
+
+        report.append({'stage': stage,
+                       'path': path,
+                       'totalBytes': s.f_blocks * s.f_frsize,
+                       'freeBytes': s.f_bavail * s.f_frsize,
+                       'reservedBytes': sum(r['bytes'] for r in reservations if r['device'] == device),
+                       'retainedBytes': retainedBytes})
+    return report
+
+
+if __name__ == "__main__":
+    from sys import argv
+
+    if len(argv) > 1 and argv[1] == "purge":
+        print("Freed {0:.1f} MB".format(purge("--all" in argv) / 1048576.0))
+
+    gb = 1024.0 ** 3
+    print("{0:<8} {1:<20} {2:>9} {3:>9} {4:>9} {5:>9}".format("stage", "path", "total GB",
+                                                             "free GB", "resv GB", "kept GB"))
+    for u in usage():
+        print("{0:<8} {1:<20} {2:>9.1f} {3:>9.1f} {4:>9.1f} {5:>9.1f}".format(u['stage'], u['path'],
+                                                                              u['totalBytes'] / gb,
+                                                                              u['freeBytes'] / gb,
+                                                                              u['reservedBytes'] / gb,
+                                                                              u['retainedBytes'] / gb))
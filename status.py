@@ -0,0 +1,175 @@
+#!/usr/bin/python
+#
+#       What the pipeline is doing right now
+#
+#       Author: Kyle Dunn (kdunn[9][2][6][@]gmail)
+#               (c) Dunn Infinite Designs LLC (2015)
+#
+#       Shows the runs in flight per stage, what is waiting to
+#       be loaded, upload throughput, Hive statement durations
+#       and the slowest data sets over a window (24 hours unless
+#       given), merged from every node's metrics index (see
+#       metrics.py):
+#
+#               $ python /data/scripts/status.py
+#               $ python /data/scripts/status.py --hours 168 --top 5
+#
+#       Drop this node's history past metrics.retentionDays
+#       (e.g. from cron on each node):
+#
+#               $ python /data/scripts/status.py prune
+#
+
+from sys import argv, exit
+from os import listdir
+from time import time
+
+import sqlite3
+
+import pipeline
+import metrics
+import space
+
+config = pipeline.load()
+
+# Upload rate over the last few minutes
+# counts as the current rate
+currentSeconds = 300
+
+mb = 1024.0 * 1024.0
+
+
+def option(name, default):
+    if name in argv:
+        return float(argv[argv.index(name) + 1])
+    return default
+
+
+def query(statement, args=()):
+    # The rows from every node's database, skipping
+    # any that is locked or predates a table
+    rows = []
+    for path in metrics.databaseFiles(config.metrics):
+        try:
+            c = sqlite3.connect(path, timeout=5)
+            try:
+                rows.extend(c.execute(statement, args).fetchall())
+            finally:
+                c.close()
+        except sqlite3.Error:
+            continue
+    return rows
+
+
+def inFlight(now):
+    # Runs which started recently and haven't finished, less
+    # any whose process has died (other nodes' runs expire
+    # after staleSeconds)
+    rows = query("SELECT stage, item, dataset, host, pid, started FROM runs "
+                 "WHERE finished IS NULL AND started > ?",
+                 (now - config.metrics['staleSeconds'],))
+    return sorted([r for r in rows if space.isAlive(r[3], r[4])], key=lambda r: r[5])
+
+
+def uploadRate(since):
+    # (uploads, MB sent, MB/s while transferring)
+    count, sizeInBytes, seconds = 0, 0, 0.0
+    for row in query("SELECT COUNT(*), SUM(bytes), SUM(seconds) FROM timings "
+                     "WHERE kind = 'upload' AND finished > ?", (since,)):
+        count = count + row[0]
+        sizeInBytes = sizeInBytes + (row[1] or 0)
+        seconds = seconds + (row[2] or 0)
+    return count, sizeInBytes / mb, sizeInBytes / mb / max(seconds, 0.001)
+
+
+def merged(rows, combine):
+    # Rows keyed on their first column, combining
+    # the rest across databases
+    byKey = {}
+    for row in rows:
+        if row[0] in byKey:
+            byKey[row[0]] = combine(byKey[row[0]], row)
+        else:
+            byKey[row[0]] = row
+    return list(byKey.values())
+
+
+if __name__ == "__main__":
+    if len(argv) > 1 and argv[1] == "prune":
+        print("Removed {0} rows past {1} days".format(metrics.prune(config.metrics),
+                                                      config.metrics['retentionDays']))
+        exit(0)
+
+    if not metrics.databaseFiles(config.metrics):
+        print("No metrics recorded under {0}".format(config.metrics['directory']))
+        exit(1)
+
+    hours = option("--hours", 24)
+    top = int(option("--top", 10))
+
+    now = time()
+    since = now - hours * 3600
+
+    print("In flight")
+    running = inFlight(now)
+    for stage in ['intake', 'unpack', 'push']:
+        print("  {0:<8} {1:>4}".format(stage, len([r for r in running if r[0] == stage])))
+    for r in running:
+        print("    {0:<8} {1:<40} {2:<16} {3:>7.0f}s".format(r[0], r[1], r[3], now - r[5]))
+
+    print("")
+    print("Waiting")
+    todo = [f for f in listdir(config.paths['loading']) if f.endswith(".todo")]
+    print("  {0:<8} {1:>4}  {2}".format("loads", len(todo), " ".join(sorted(f[:-5] for f in todo))))
+
+    if config.distributed['enabled']:
+        import workqueue
+
+        depth = workqueue.fromConfig(config).depth()
+        print("  {0:<8} {1:>4} pending, {2} leased, {3} failed".format("queue", depth['pending'],
+                                                                      depth['leased'], depth['failed']))
+
+    print("")
+    print("Uploads")
+
+    # Progress is written every progressInterval, so a
+    # transfer which has gone quiet for a few has stopped
+    transfers = query("SELECT name, bytes, total, rate FROM progress WHERE updated > ? ORDER BY started",
+                      (now - 3 * metrics.progressInterval,))
+    print("  {0:<10} {1:>5} uploads {2:>10.1f} MB {3:>8.1f} MB/s".format("now", len(transfers),
+                                                                       sum(t[1] for t in transfers) / mb,
+                                                                       sum(t[3] for t in transfers) / mb))
+    for name, sent, total, rate in transfers:
+        print("    {0:<40} {1:>10.1f} of {2:>8} MB {3:>8.1f} MB/s".format(name, sent / mb,
+                                                                        "?" if not total else
+                                                                        "{0:.1f}".format(total / mb),
+                                                                        rate / mb))
+
+    for label, start in [("last {0:.0f}m".format(currentSeconds / 60.0), now - currentSeconds),
+                         ("last {0:g}h".format(hours), since)]:
+        count, sent, rate = uploadRate(start)
+        print("  {0:<10} {1:>5} uploads {2:>10.1f} MB {3:>8.1f} MB/s".format(label, count, sent, rate))
+
+    print("")
+    print("Hive statements, last {0:g}h".format(hours))
+    print("  {0:<18} {1:>6} {2:>6} {3:>9} {4:>9}".format("statement", "runs", "failed", "avg s", "max s"))
+    statements = merged(query("SELECT name, COUNT(*), SUM(1 - ok), SUM(seconds), MAX(seconds) FROM timings "
+                              "WHERE kind = 'hive' AND finished > ? GROUP BY name", (since,)),
+                        lambda a, b: (a[0], a[1] + b[1], a[2] + b[2], a[3] + b[3], max(a[4], b[4])))
+    for name, runs, failed, seconds, longest in sorted(statements, key=lambda s: -s[3]):
+        print("  {0:<18} {1:>6} {2:>6} {3:>9.1f} {4:>9.1f}".format(name, runs, failed,
+                                                                    seconds / runs, longest))
+
+    print("")
+    print("Slowest data sets, last {0:g}h".format(hours))
+    print("  {0:<22} {1:>6} {2:>9} {3:>9}  {4}".format("data set", "loads", "avg s", "max s", "last result"))
+    dataSets = merged(query("SELECT dataset, COUNT(*), SUM(finished - started), MAX(finished - started), "
+                            "MAX(finished), (SELECT result FROM runs r WHERE r.stage = 'push' "
+                            " AND r.dataset = runs.dataset AND r.finished IS NOT NULL "
+                            " ORDER BY r.finished DESC LIMIT 1) "
+                            "FROM runs WHERE stage = 'push' AND finished > ? GROUP BY dataset", (since,)),
+                      lambda a, b: (a[0], a[1] + b[1], a[2] + b[2], max(a[3], b[3]),
+                                    max(a[4], b[4]), a[5] if a[4] >= b[4] else b[5]))
+    for dataSet, loads, seconds, longest, last, result in sorted(dataSets, key=lambda d: -d[3])[:top]:
+        print("  {0:<22} {1:>6} {2:>9.1f} {3:>9.1f}  {4}".format(dataSet, loads, seconds / loads,
+                                                                  longest, result))
@@ -23,22 +23,53 @@
 
 
 from sys import argv
+
+fullFilePath = argv[1]
+filename = fullFilePath.split('/')[-1]
+
+# Hidden files are scratch space (e.g. compacted
+# artifacts), never deliveries, so settle them before
+# importing anything heavy or touching /data
+if filename.startswith('.'):
+    exit(0)
+
+import os
+
 from os import stat, devnull
 from zipfile import ZipFile 
 from shutil import move
 from time import time
 from subprocess import Popen, STDOUT
 
-fullFilePath = argv[1]
-filename = fullFilePath.split('/')[-1]
+import pipeline
+import clients
+import space
+import metrics
+
+config = pipeline.load()
 
-unzipUtil = "/usr/bin/7z"
-loadingDir = "/data/loading"
-metaDir = "/data/meta"
+# A worker node extracting a single member
+# on behalf of a distributed unpack
+onlyMember = None
+if "--member" in argv:
+    onlyMember = argv[argv.index("--member") + 1]
 
-passwordFile = open('/etc/key', 'r')
-theDataPassword = passwordFile.read().strip()
-passwordFile.close()
+# The archive's group in the work queue, finished
+# once every member has been extracted
+memberOf = None
+if "--group" in argv:
+    memberOf = argv[argv.index("--group") + 1]
+
+# Stands in for the fan-out itself, so the group
+# can't finish before every member is queued
+fanOutMember = ".fanout"
+
+unzipUtil = config.unpack['unzipUtil']
+loadingDir = config.paths['loading']
+metaDir = config.paths['meta']
+rowCountsFile = config.unpack['rowCountsFile']
+
+theDataPassword = clients.readSecret(config.unpack['passwordFile'])
 
 
 def getFileStats(fullFilePath):
@@ -76,22 +107,67 @@ def makeRecord(filename, path, code, startTime):
 # waiting for this file to compare row counts
 unzipCommand = "{prog} x {fname} {member} -o{dest} -p{passwd}".format(prog=unzipUtil,
                                                                       fname=fullFilePath,
-                                                                      member='RowCounts.txt',
+                                                                      member=rowCountsFile,
                                                                       dest=loadingDir,
                                                                       passwd=theDataPassword)
 
 statusDict = {}
 
 isClaims = False
-if "ADA" in filename.upper():
+if config.isClaims(filename):
     isClaims = True
 
 if not isClaims:
 
     # Used to supress output
     devNull = open(devnull, 'w')
-    p = Popen(unzipCommand, shell=True, stdout=devNull, stderr=STDOUT)
-    p.wait()
+
+    queue = None
+    if config.distributed['enabled'] and onlyMember is None:
+        import workqueue
+
+        queue = workqueue.fromConfig(config)
+
+        # Only one node fans out a given delivery, even when
+        # several are watching the same staging directory
+        fileStatInfo = stat(fullFilePath)
+        memberOf = "unpack-{0}-{1}-{2}".format(filename, fileStatInfo.st_size,
+                                               int(fileStatInfo.st_mtime))
+        if not queue.decideOnce(memberOf):
+            exit(0)
+
+        queue.addToGroup(memberOf, fanOutMember)
+
+    runId = metrics.begin(config.metrics, 'unpack', onlyMember or filename)
+
+    # Reserve the expanded size up front, a delivery
+    # that can't fit fails here rather than part way
+    # through extraction with an obscure 7z return code
+    reservation = None
+    if queue is None:
+        with ZipFile(fullFilePath) as zf:
+            expandedBytes = sum(m.file_size for m in zf.infolist()
+                                if onlyMember is None or m.filename == onlyMember)
+
+        reservation = space.reserve(loadingDir, expandedBytes, filename)
+        if reservation is None:
+            # Make room from artifacts past their retention
+            space.purge()
+            reservation = space.reserve(loadingDir, expandedBytes, filename)
+
+        if reservation is None:
+            theFile = open(metaDir + '/extract', 'a')
+            theFile.write(makeRecord(filename, "", "NO SPACE:{0}".format(expandedBytes), int(time())))
+            theFile.close()
+
+            metrics.end(config.metrics, runId, "NO SPACE")
+            exit(1)
+
+    allExtracted = True
+
+    if onlyMember is None:
+        p = Popen(unzipCommand, shell=True, stdout=devNull, stderr=STDOUT)
+        p.wait()
 
 
 
@@ -100,6 +176,9 @@ if not isClaims:
         # against path traversal issues
         # alternatively, use zf.extractall()
         for member in zf.infolist():
+            if onlyMember is not None and member.filename != onlyMember:
+                continue
+
             # Path traversal defense copied from
             # http://hg.python.org/cpython/file/tip/Lib/http/server.py#l789
             words = member.filename.split('/')
@@ -112,7 +191,15 @@ if not isClaims:
                     continue
                 path = os.path.join(path, word)
 
-            if member.filename == 'RowCounts.txt':
+            if member.filename == rowCountsFile:
+                continue
+
+            if queue is not None:
+                # Let the worker nodes extract
+                # members of this archive in parallel
+                queue.addToGroup(memberOf, member.filename)
+                queue.enqueue('extract', {'archive': fullFilePath, 'member': member.filename,
+                                          'group': memberOf})
                 continue
 
             # Wrap this up to log errors, if necessary
@@ -137,21 +224,44 @@ if not isClaims:
                 if p.returncode == 0:
                     statusDict[member] = makeRecord(member.filename, path, "OK", startTime)
 
-                    todoFile = "touch {p}/{f}.todo".format(p=path, f=member.filename.split(".")[0])
-                    t = Popen(todoFile.split())
-                    t.wait()
+                    # Flag the data set for push.py
+                    todoFile = "{p}/{f}.todo".format(p=path, f=member.filename.split(".")[0])
+                    open(todoFile, 'a').close()
                 else:
+                    allExtracted = False
                     statusDict[member] = makeRecord(member.filename, path, p.returncode, startTime)
                 #print "Extracted", member.filename, "to", path
 
             except OSError as e:
                 #print "Caught exception for", member.filename, e[0]
+                allExtracted = False
                 statusDict[member] = makeRecord(member.filename, path, e[0])
                 pass
 
     devNull.close()
 
+    if reservation is not None:
+        space.release(reservation)
+
+        # The archive itself is no longer needed once
+        # every member made it into the loading directory
+        if onlyMember is None and allExtracted:
+            space.confirm(fullFilePath, 'staging')
+
+    # Distributed, that's once the last member's
+    # worker (or the fan-out itself) finishes
+    if queue is not None:
+        if queue.finishMember(memberOf, fanOutMember):
+            space.confirm(fullFilePath, 'staging')
+    elif memberOf is not None and allExtracted:
+        import workqueue
+
+        if workqueue.fromConfig(config).finishMember(memberOf, onlyMember):
+            space.confirm(fullFilePath, 'staging')
+
 else:
+    runId = metrics.begin(config.metrics, 'unpack', filename)
+
     newFile = filename.split(".")[0]
 
     sClaim = 'cat {fname} | bsdtar -xOf- | egrep "^S"'.format(fname=fullFilePath)
@@ -185,3 +295,14 @@ for datafile in statusDict.keys():
     theFile.write(record)
 
 theFile.close()
+
+# The last field of each record is its return code
+failures = len([r for r in statusDict.values() if not r.rstrip().endswith(",OK")])
+if not isClaims and queue is not None:
+    metrics.end(config.metrics, runId, "QUEUED")
+elif failures:
+    metrics.end(config.metrics, runId, "{0} FAILED".format(failures))
+    # So the worker retries the extraction (see worker.py)
+    exit(1)
+else:
+    metrics.end(config.metrics, runId, "OK")
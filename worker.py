@@ -0,0 +1,150 @@
+#!/usr/bin/python
+#
+#       Distributed-mode worker, claims extraction and
+#       upload tasks from the shared work queue
+#
+#       Author: Kyle Dunn (kdunn[9][2][6][@]gmail)
+#               (c) Dunn Infinite Designs LLC (2015)
+#
+#       Run one worker per node (e.g. from an init script or
+#       supervisor) with the same pipeline definition on all
+#       nodes and distributed.enabled set to true:
+#
+#               $ /data/scripts/worker.py
+#
+#       unpack.py and push.py enqueue tasks instead of doing the
+#       work themselves when distributed mode is on. Each claimed
+#       task runs the same stage script it would have run locally
+#       against the shared loading directory. A push is only
+#       claimed once the load ahead of it in its lane has finished
+#       (its .todo is gone), so waiting never holds a slot and
+#       every node loads a lane in the same order.
+#
+#       A task whose stage exits non-zero (it crashed, 7z failed
+#       on a member, or the upload or Hive load failed) is
+#       retried on any node until it has used maxAttempts,
+#       then parked under failed/ in the queue directory.
+#
+
+from sys import argv, executable
+from os import setsid, killpg
+from os.path import dirname, abspath, join, isfile
+from signal import SIGTERM
+from time import sleep, time
+from subprocess import Popen
+
+import pipeline
+import workqueue
+
+config = pipeline.load()
+settings = config.distributed
+
+scriptsDir = dirname(abspath(__file__))
+
+# How each task kind maps onto a stage invocation
+handlers = {
+    'extract': lambda args: [executable, join(scriptsDir, "unpack.py"), args['archive'], "--member", args['member']]
+                            + (["--group", args['group']] if args.get('group') else []),
+    'push': lambda args: [executable, join(scriptsDir, "push.py"), args['path'], "--claimed"]
+}
+
+
+
+def isReady(task):
+    # Same rule push.py applies when run locally: wait for
+    # the previous load in the lane, but not past maxWaitSeconds
+    if task.kind != 'push':
+        return True
+
+    path = task.args['path']
+    dataSetType = path.split('/')[-1].split('.')[0]
+    if config.dataSet(dataSetType) is None:
+        return True
+
+    predecessors = config.lanePredecessors(dataSetType)
+    if not predecessors:
+        return True
+
+    previousTodoFile = join(dirname(path), predecessors[0] + ".todo")
+    if not isfile(previousTodoFile):
+        return True
+
+    return time() - task.enqueued >= config.maxWaitSeconds(dataSetType)
+
+
+logFile = config.paths['logs'] + "/worker-{0}.log".format(str(int(time())))
+
+theLog = open(logFile, 'w+')
+
+queue = workqueue.fromConfig(config)
+
+theLog.write("Worker {0} started, queue {1}, {2} slots\n\n".format(queue.nodeName,
+                                                                    settings['queueDir'],
+                                                                    settings['slots']))
+theLog.flush()
+
+# Leases are renewed well before they lapse
+renewInterval = settings['leaseSeconds'] / 3.0
+
+# Task id -> (task, process, last renewal)
+running = {}
+lastHousekeeping = 0
+
+while True:
+    now = time()
+
+    # Return abandoned work to the queue and
+    # trim the history of finished tasks
+    if now - lastHousekeeping >= settings['leaseSeconds']:
+        reclaimed = queue.reclaimExpired()
+        if reclaimed:
+            theLog.write("Reclaimed {0} expired lease(s)\n".format(reclaimed))
+        queue.purgeDone(settings['doneRetentionSeconds'])
+        lastHousekeeping = now
+
+    for taskId in list(running):
+        task, p, lastRenewal = running[taskId]
+
+        if p.poll() is None:
+            if now - lastRenewal >= renewInterval:
+                if queue.renew(task):
+                    running[taskId] = (task, p, now)
+                else:
+                    # Someone else owns it now, stop duplicating work
+                    theLog.write("Lost lease on {0}, terminating\n".format(task.name))
+                    # Including the 7z or beeline it started
+                    try:
+                        killpg(p.pid, SIGTERM)
+                    except OSError:
+                        pass
+                    p.wait()
+                    del running[taskId]
+            continue
+
+        if p.returncode == 0:
+            queue.complete(task)
+            theLog.write("Completed {0} {1}\n".format(task.kind, task.args))
+        else:
+            queue.fail(task)
+            theLog.write("Failed {0} {1} (attempt {2}, code {3})\n".format(task.kind, task.args,
+                                                                          task.attempts, p.returncode))
+        del running[taskId]
+
+    while len(running) < settings['slots']:
+        task = queue.claim(kinds=list(handlers), ready=isReady)
+        if task is None:
+            break
+
+        theLog.write("Claimed {0} {1}\n".format(task.kind, task.args))
+        # Each task gets its own process group so that
+        # a lost lease stops everything it started
+        running[task.id] = (task, Popen(handlers[task.kind](task.args), preexec_fn=setsid), time())
+
+    theLog.flush()
+
+    if "--once" in argv and not running:
+        break
+
+    sleep(settings['pollSeconds'])
+
+theLog.close()
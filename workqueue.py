@@ -0,0 +1,282 @@
+#
+#       Shared, file-backed work queue for spreading
+#       extraction and upload work across several nodes
+#
+#       Author: Kyle Dunn (kdunn[9][2][6][@]gmail)
+#               (c) Dunn Infinite Designs LLC (2015)
+#
+#       The queue directory must live on storage every worker
+#       node mounts (e.g. the NFS export holding /data/staging
+#       and /data/loading). All state transitions are a single
+#       rename() within that directory, so exactly one node wins
+#       any claim, renewal or reclaim:
+#
+#               pending/<task>                      waiting for a worker
+#               leased/<task>@<node>@<expiry>       claimed until <expiry>
+#               done/<task>                         finished
+#               failed/<task>                       gave up after maxAttempts
+#               decisions/<key>                     one-time decisions (O_EXCL)
+#               groups/<group>/<member>             unfinished members of a task group
+#               tmp/                                partially written files
+#
+
+from os import listdir, rename, open as osOpen, write, close, remove, makedirs, stat, rmdir
+from shutil import rmtree
+from os import O_CREAT, O_EXCL, O_WRONLY
+from os.path import join, isdir
+from json import dumps, loads
+from socket import gethostname
+from time import time
+from uuid import uuid4
+
+subDirs = ['pending', 'leased', 'done', 'failed', 'decisions', 'groups', 'tmp']
+
+
+class Task(object):
+
+    def __init__(self, name, body, leasePath=None):
+        self.name = name
+        self.id = body['id']
+        self.kind = body['kind']
+        self.args = body['args']
+        self.attempts = body.get('attempts', 0)
+        self.enqueued = body['enqueued']
+        self.leasePath = leasePath
+
+    def body(self):
+        return {'id': self.id, 'kind': self.kind, 'args': self.args,
+                'attempts': self.attempts, 'enqueued': self.enqueued}
+
+
+class WorkQueue(object):
+
+    def __init__(self, queueDir, nodeName=None, leaseSeconds=600, maxAttempts=3):
+        self.queueDir = queueDir
+        self.nodeName = (nodeName or gethostname()).replace('@', '_')
+        self.leaseSeconds = leaseSeconds
+        self.maxAttempts = maxAttempts
+
+        for d in subDirs:
+            if not isdir(join(queueDir, d)):
+                try:
+                    makedirs(join(queueDir, d))
+                except OSError:
+                    # Another node created it first
+                    pass
+
+    def _path(self, subDir, name):
+        return join(self.queueDir, subDir, name)
+
+    def _writeAtomically(self, path, body):
+        tmpPath = self._path('tmp', uuid4().hex)
+        with open(tmpPath, 'w') as f:
+            f.write(dumps(body))
+        rename(tmpPath, path)
+
+    def enqueue(self, kind, args):
+        # Zero-padded enqueue time keeps
+        # a directory listing in FIFO order
+        now = time()
+        taskId = uuid4().hex
+        name = "{0:015.3f}-{1}-{2}".format(now, kind, taskId)
+
+        body = {'id': taskId, 'kind': kind, 'args': args,
+                'attempts': 0, 'enqueued': now}
+
+        # Write outside pending/ so no worker sees a partial task
+        self._writeAtomically(self._path('pending', name), body)
+        return taskId
+
+    def decideOnce(self, key):
+        # True for exactly one caller across all nodes, used
+        # so that duplicate incrond events (one per node watching
+        # a shared directory) result in a single action
+        try:
+            fd = osOpen(self._path('decisions', key.replace('/', '_')),
+                        O_CREAT | O_EXCL | O_WRONLY)
+        except OSError:
+            return False
+
+        write(fd, "{0} {1}\n".format(self.nodeName, int(time())).encode())
+        close(fd)
+        return True
+
+    def enqueueOnce(self, key, kind, args):
+        if self.decideOnce(key):
+            return self.enqueue(kind, args)
+        return None
+
+    def _groupPath(self, group, member=None):
+        path = self._path('groups', group.replace('/', '_'))
+        if member is None:
+            return path
+        return join(path, member.replace('/', '_'))
+
+    def addToGroup(self, group, member):
+        # Track a member (e.g. one archive entry) whose task
+        # must finish before the group as a whole is done
+        if not isdir(self._groupPath(group)):
+            try:
+                makedirs(self._groupPath(group))
+            except OSError:
+                pass
+        open(self._groupPath(group, member), 'a').close()
+
+    def finishMember(self, group, member):
+        # True for exactly one caller, the one
+        # finishing the group's last member
+        try:
+            remove(self._groupPath(group, member))
+        except OSError:
+            return False
+
+        try:
+            rmdir(self._groupPath(group))
+        except OSError:
+            # Members still outstanding, or another
+            # caller removed the group first
+            return False
+        return True
+
+    def _leaseName(self, name, expiry):
+        return "{0}@{1}@{2}".format(name, self.nodeName, int(expiry))
+
+    def _parseLease(self, leaseName):
+        name, node, expiry = leaseName.rsplit('@', 2)
+        return name, node, int(expiry)
+
+    def _readPending(self, name):
+        try:
+            with open(self._path('pending', name)) as f:
+                return Task(name, loads(f.read()))
+        except (IOError, OSError, ValueError):
+            # Claimed (or still being renamed) by another worker
+            return None
+
+    def claim(self, kinds=None, ready=None):
+        # The oldest pending task of the given kinds for
+        # which ready(task) holds, tasks that aren't ready
+        # stay queued for any node to pick up later
+        for name in sorted(listdir(join(self.queueDir, 'pending'))):
+            if kinds is not None and name.split('-')[1] not in kinds:
+                continue
+
+            if ready is not None:
+                pending = self._readPending(name)
+                if pending is None or not ready(pending):
+                    continue
+
+            leaseName = self._leaseName(name, time() + self.leaseSeconds)
+            leasePath = self._path('leased', leaseName)
+            try:
+                rename(self._path('pending', name), leasePath)
+            except OSError:
+                # Claimed by another worker in the meantime
+                continue
+
+            with open(leasePath) as f:
+                task = Task(name, loads(f.read()), leasePath)
+
+            task.attempts = task.attempts + 1
+            self._writeAtomically(leasePath, task.body())
+            return task
+
+        return None
+
+    def renew(self, task):
+        # Extend the lease; False means it already
+        # expired and another node reclaimed the task
+        newPath = self._path('leased', self._leaseName(task.name, time() + self.leaseSeconds))
+        try:
+            rename(task.leasePath, newPath)
+        except OSError:
+            return False
+        task.leasePath = newPath
+        return True
+
+    def complete(self, task):
+        try:
+            rename(task.leasePath, self._path('done', task.name))
+        except OSError:
+            return False
+        return True
+
+    def fail(self, task):
+        # Requeue the task, or park it once it has
+        # used up its attempts
+        target = 'pending'
+        if task.attempts >= self.maxAttempts:
+            target = 'failed'
+
+        try:
+            rename(task.leasePath, self._path(target, task.name))
+        except OSError:
+            return False
+        return True
+
+    def _attempts(self, leaseName):
+        try:
+            with open(self._path('leased', leaseName)) as f:
+                return loads(f.read()).get('attempts', 0)
+        except (IOError, OSError, ValueError):
+            return 0
+
+    def reclaimExpired(self):
+        # Return tasks whose worker stopped renewing
+        # (crashed node, killed worker) to the queue, or
+        # park them once they have used up their attempts
+        reclaimed = 0
+        now = time()
+        for leaseName in listdir(join(self.queueDir, 'leased')):
+            name, node, expiry = self._parseLease(leaseName)
+            if expiry > now:
+                continue
+
+            target = 'pending'
+            if self._attempts(leaseName) >= self.maxAttempts:
+                target = 'failed'
+
+            try:
+                rename(self._path('leased', leaseName), self._path(target, name))
+                reclaimed = reclaimed + 1
+            except OSError:
+                pass
+        return reclaimed
+
+    def depth(self):
+        return dict((d, len(listdir(join(self.queueDir, d))))
+                    for d in ['pending', 'leased', 'failed'])
+
+    def purgeDone(self, olderThanSeconds):
+        # Finished tasks, and decisions old enough that
+        # no duplicate event for them can still arrive
+        cutoff = time() - olderThanSeconds
+        for name in listdir(join(self.queueDir, 'done')):
+            if float(name.split('-')[0]) < cutoff:
+                try:
+                    remove(self._path('done', name))
+                except OSError:
+                    pass
+
+        for name in listdir(join(self.queueDir, 'decisions')):
+            try:
+                if stat(self._path('decisions', name)).st_mtime < cutoff:
+                    remove(self._path('decisions', name))
+            except OSError:
+                pass
+
+        # Groups whose members failed for good
+        for name in listdir(join(self.queueDir, 'groups')):
+            try:
+                if stat(self._path('groups', name)).st_mtime < cutoff:
+                    rmtree(self._path('groups', name))
+            except OSError:
+                pass
+
+
+def fromConfig(config):
+    settings = config.distributed
+    return WorkQueue(settings['queueDir'],
+                     nodeName=settings['nodeName'],
+                     leaseSeconds=settings['leaseSeconds'],
+                     maxAttempts=settings['maxAttempts'])